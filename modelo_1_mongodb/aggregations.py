@@ -0,0 +1,46 @@
+def group_then_resolve(id, fields, sort, skip, limit, resolve, group=None, add_fields=None):
+    """Build a pipeline that groups on ids, pages the groups and only then joins their names.
+
+    id is the _id of every returned row, written in terms of the resolved fields.
+    resolve maps each resolved field to the (id field, collection) holding its name.
+    group is skipped when the source collection is already grouped (e.g. route_stats).
+    """
+    pipeline = []
+    if group is not None:
+        pipeline.append({"$group": group})
+    if add_fields:
+        pipeline.append({"$addFields": add_fields})
+    pipeline += [
+        {
+            "$sort": sort
+        },
+        {
+            "$skip": skip
+        },
+        {
+            "$limit": limit
+        }
+    ]
+
+    # the join runs once per surviving row instead of once per flight
+    for field, (key, collection) in resolve.items():
+        pipeline += [
+            {
+                "$lookup": {
+                    "from": collection,
+                    "localField": key,
+                    "foreignField": "_id",
+                    "as": field
+                }
+            },
+            {
+                "$addFields": {
+                    field: {"$ifNull": [{"$arrayElemAt": [f"${field}.name", 0]}, f"${key}"]}
+                }
+            }
+        ]
+
+    pipeline.append({
+        "$project": {"_id": id, **{field: 1 for field in fields}}
+    })
+    return pipeline
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Latency and throughput of every API route, served in process by uvicorn against a seeded database
+Run it from the modelo_1_mongodb directory against a running mongodb instance, or an in-process
+mongomock stand-in when none answers (or with --standin), and keep the JSON results to compare commits:
+    python3 -m benchmarks.api_routes --flights 1M --output results/$(git rev-parse --short HEAD).json
+    python3 -m benchmarks.api_routes --flights 10k --compare results/<previous commit>.json
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from data.flight_data import PROFILES, Categorical, generate_chunk, make_workload
+from rollups import FlightTimeSeries, RouteStats
+
+
+MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
+DB_NAME = os.getenv('MONGODB_BENCH_DB_NAME', 'flight_passenger_bench')
+SCALES = {"k": 1_000, "m": 1_000_000}
+
+
+def flights_count(value):
+    # 10k, 1M, 10M or a plain number of flights
+    suffix = value[-1].lower()
+    return int(float(value[:-1]) * SCALES[suffix]) if suffix in SCALES else int(value)
+
+
+def decode(column):
+    if isinstance(column, Categorical):
+        return np.array(column.values, dtype=object)[column.codes].tolist()
+    return column.tolist()
+
+
+def seed(database, flights, workload, seed_value, batch_size=50_000):
+    """Load the workload catalogs and flights straight into the database, then build the rollups."""
+    for collection in ("airlines", "cities", "flights", RouteStats.collection, FlightTimeSeries.collection):
+        database.drop_collection(collection)
+
+    airline_ids = [str(uuid.uuid4()) for _ in workload.airlines]
+    city_ids = [str(uuid.uuid4()) for _ in workload.airports]
+    database["airlines"].insert_many([{"_id": _id, "name": name} for _id, name in zip(airline_ids, workload.airlines)])
+    database["cities"].insert_many([{"_id": _id, "name": name} for _id, name in zip(city_ids, workload.airports)])
+
+    chunks = [min(batch_size, flights - start) for start in range(0, flights, batch_size)]
+    flight_ids = []
+    for chunk_seed, rows in zip(np.random.SeedSequence(seed_value).spawn(len(chunks)), chunks):
+        columns = generate_chunk(np.random.default_rng(chunk_seed), rows, workload)
+        documents = {
+            "_id": [str(uuid.uuid4()) for _ in range(rows)],
+            "airline_id": np.array(airline_ids, dtype=object)[columns.pop("airline").codes].tolist(),
+            "from_city_id": np.array(city_ids, dtype=object)[columns.pop("from").codes].tolist(),
+            "to_city_id": np.array(city_ids, dtype=object)[columns.pop("to").codes].tolist(),
+            **{field: decode(column) for field, column in columns.items()}
+        }
+        # the API stores carry_on as a string
+        documents["carry_on"] = [str(value) for value in documents["carry_on"]]
+        database["flights"].insert_many([dict(zip(documents, values)) for values in zip(*documents.values())], ordered=False)
+        flight_ids += documents["_id"][:1000]
+
+    # the rollups are grouped here and inserted, which the in-process stand-in supports unlike $merge
+    for rollup in (RouteStats, FlightTimeSeries):
+        groups = list(database["flights"].aggregate(rollup.rebuild_pipeline[:-1], allowDiskUse=True))
+        for start in range(0, len(groups), batch_size):
+            database[rollup.collection].insert_many(groups[start:start + batch_size], ordered=False)
+
+    return {"flights": flight_ids, "airlines": airline_ids, "cities": city_ids}
+
+
+def post_bodies(workload, rng, count):
+    columns = generate_chunk(rng, count, workload)
+    rows = [dict(zip(columns, values)) for values in zip(*(decode(column) for column in columns.values()))]
+    for row in rows:
+        row["from_city"] = row.pop("from")
+        row["carry_on"] = str(row["carry_on"])
+    return rows
+
+
+def route_requests(ids, workload, count, seed_value):
+    """(method, path, request kwargs) of count requests for every route, drawn from the seeded ids."""
+    pick = random.Random(seed_value)
+    bodies = post_bodies(workload, np.random.default_rng(seed_value), count)
+    return {
+        "GET /flight/": [("GET", "/flight/", {"params": {"limit": 20, "skip": pick.randrange(1000)}}) for _ in range(count)],
+        "GET /flight/{id}": [("GET", f"/flight/{pick.choice(ids['flights'])}", {}) for _ in range(count)],
+        "GET /flight/common_destinations/": [("GET", "/flight/common_destinations/", {"params": {"limit": 5}})] * count,
+        "GET /flight/average_duration/": [("GET", "/flight/average_duration/", {"params": {"limit": 10}})] * count,
+        "GET /flight/popular_airlines/": [("GET", "/flight/popular_airlines/", {"params": {"limit": 2}})] * count,
+        "GET /flight/timeseries": [("GET", "/flight/timeseries", {"params": {"city": pick.choice(workload.airports)}}) for _ in range(count)],
+        "GET /airline/{id}": [("GET", f"/airline/{pick.choice(ids['airlines'])}", {}) for _ in range(count)],
+        "GET /city/{id}": [("GET", f"/city/{pick.choice(ids['cities'])}", {}) for _ in range(count)],
+        # last, the inserted flights change what the other routes read
+        "POST /flight/": [("POST", "/flight/", {"json": body}) for body in bodies],
+    }
+
+
+def percentile(latencies, fraction):
+    return latencies[max(int(len(latencies) * fraction) - 1, 0)]
+
+
+def run(base_url, route_requests, concurrency, warmup):
+    local = threading.local()
+
+    def send(request):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        method, path, kwargs = request
+        start = time.perf_counter()
+        response = local.session.request(method, base_url + path, **kwargs)
+        return time.perf_counter() - start, response.ok
+
+    for request in route_requests[:warmup]:
+        send(request)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, route_requests))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "throughput": len(results) / elapsed,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000
+    }
+
+
+def mongod_available(uri):
+    try:
+        MongoClient(uri, serverSelectionTimeoutMS=1000).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+def standin_client():
+    import mongomock
+    import mongomock.collection
+
+    # pymongo 4.11+ passes a sort to the bulk updates, which older mongomock releases do not take
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+    if "sort" not in add_update.__code__.co_varnames:
+        mongomock.collection.BulkOperationBuilder.add_update = lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+    return mongomock.MongoClient()
+
+
+def serve(app, port):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    print(f"=== compared to {previous.get('commit') or 'previous run'} ===")
+    for route, result in results["routes"].items():
+        before = previous["routes"].get(route)
+        if before is None:
+            continue
+        changes = ", ".join(
+            f"{metric} {before[metric]:.1f} -> {result[metric]:.1f} ({(result[metric] / before[metric] - 1) * 100:+.0f}%)"
+            for metric in ("p50_ms", "p99_ms", "throughput") if before[metric]
+        )
+        print(f"{route}: {changes}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-f", "--flights",
+            help="Amount of flights seeded, i.e. 10k, 1M or 10M, defaults to: 10k", type=flights_count, default="10k")
+    parser.add_argument("-p", "--profile", choices=list(PROFILES),
+            help="Workload profile of the seeded flights, defaults to: uniform", default="uniform")
+    parser.add_argument("-s", "--seed",
+            help="Seed of the flights and of the requests, defaults to: 42", type=int, default=42)
+    parser.add_argument("-n", "--requests",
+            help="Amount of requests sent to every route, defaults to: 1000", type=int, default=1000)
+    parser.add_argument("-c", "--concurrency",
+            help="Amount of concurrent clients, defaults to: 8", type=int, default=8)
+    parser.add_argument("-w", "--warmup",
+            help="Requests sent to every route before measuring, defaults to: 20", type=int, default=20)
+    parser.add_argument("--port",
+            help="Port the API is served on, defaults to: 8100", type=int, default=8100)
+    parser.add_argument("--standin", action="store_true",
+            help="Use the in-process mongomock stand-in even when a mongodb instance is running")
+    parser.add_argument("--response-cache", action="store_true",
+            help="Keep the analytics response cache on, by default every request is computed")
+    parser.add_argument("-o", "--output",
+            help="JSON file the results are saved to")
+    parser.add_argument("--compare",
+            help="JSON results of a previous run to compare with")
+
+    args = parser.parse_args()
+
+    # the app reads its settings when imported
+    os.environ["MONGODB_DB_NAME"] = DB_NAME
+    if not args.response_cache:
+        os.environ["RESPONSE_CACHE_TTL_SECONDS"] = "0"
+    import main
+
+    backend = "mongod" if not args.standin and mongod_available(MONGODB_URI) else "mongomock"
+    if backend == "mongod":
+        client = MongoClient(MONGODB_URI)
+    else:
+        print(f"No mongodb instance answering at {MONGODB_URI}, using the in-process mongomock stand-in")
+        client = standin_client()
+        # the app has to share the stand-in client holding the seeded data
+        main.MongoClient = lambda *args, **kwargs: client
+        main.MONGODB_DRIVER = "pymongo"
+
+    profile = {name: value for name, value in PROFILES[args.profile].items() if name != "seed"}
+    workload = make_workload(**profile)
+    print(f"Seeding {args.flights} flights ({args.profile} profile) into {DB_NAME} on {backend}")
+    start = time.perf_counter()
+    ids = seed(client[DB_NAME], args.flights, workload, args.seed)
+    print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+    server = serve(main.app, args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+    # measure with the indexes the app builds at startup
+    while requests.get(base_url + "/index/").json()["state"] in ("pending", "building"):
+        time.sleep(0.5)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "backend": backend,
+        "driver": main.MONGODB_DRIVER,
+        "flights": args.flights,
+        "profile": args.profile,
+        "seed": args.seed,
+        "concurrency": args.concurrency,
+        "response_cache": args.response_cache,
+        "routes": {}
+    }
+    for route, route_request_list in route_requests(ids, workload, args.requests, args.seed).items():
+        result = run(base_url, route_request_list, args.concurrency, args.warmup)
+        results["routes"][route] = result
+        print(f"{route}: p50 {result['p50_ms']:.1f}ms, p99 {result['p99_ms']:.1f}ms, {result['throughput']:.0f} req/s, {result['errors']} errors")
+
+    server.should_exit = True
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent=2)
+        print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(results, json.load(fd))
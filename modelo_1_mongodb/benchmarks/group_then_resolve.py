@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Compares the $lookup-before-$group analytics pipelines with the group-then-resolve ones
+Run it from the modelo_1_mongodb directory against a running mongodb instance:
+    python3 -m benchmarks.group_then_resolve --flights 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+import uuid
+
+from pymongo import MongoClient
+
+from aggregations import group_then_resolve
+from rollups import ROUTE_STATS_COLLECTION, RouteStats
+
+
+MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
+DB_NAME = os.getenv('MONGODB_BENCH_DB_NAME', 'flight_passenger_bench')
+
+airlines = ["American Airlines", "Delta Airlines", "Alaska", "Aeromexico", "Volaris"]
+airports = ["PDX", "GDL", "SJC", "LAX", "JFK"]
+
+
+def lookup(collection, local_field, field):
+    return [
+        {"$lookup": {"from": collection, "localField": local_field, "foreignField": "_id", "as": field}},
+        {"$unwind": f"${field}"}
+    ]
+
+
+def route_lookups():
+    return lookup("cities", "from_city_id", "from_city") + lookup("cities", "to_city_id", "to_city")
+
+
+def route_resolve():
+    return {"from_city": ("_id.from_city_id", "cities"), "to_city": ("_id.to_city_id", "cities")}
+
+
+def route_group(accumulators):
+    return {"_id": {"from_city_id": "$from_city_id", "to_city_id": "$to_city_id"}, **accumulators}
+
+
+# (collection, pipeline) for every variant of every endpoint
+PIPELINES = {
+    "popular_airlines": {
+        "lookup_then_group": ("flights", lookup("airlines", "airline_id", "airline") + [
+            {"$group": {"_id": "$airline.name", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}}, {"$skip": 0}, {"$limit": 2}
+        ]),
+        "group_then_resolve": ("flights", group_then_resolve(
+            id="$airline", fields=["count"], group={"_id": "$airline_id", "count": {"$sum": 1}},
+            sort={"count": -1, "_id": 1}, skip=0, limit=2, resolve={"airline": ("_id", "airlines")}
+        ))
+    },
+    "common_destinations": {
+        "lookup_then_group": ("flights", route_lookups() + [
+            {"$group": {"_id": {"from_city": "$from_city.name", "to_city": "$to_city.name"}, "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}}, {"$skip": 0}, {"$limit": 5}
+        ]),
+        "group_then_resolve": ("flights", group_then_resolve(
+            id={"from_city": "$from_city", "to_city": "$to_city"}, fields=["count"], group=route_group({"count": {"$sum": 1}}),
+            sort={"count": -1, "_id": 1}, skip=0, limit=5, resolve=route_resolve()
+        )),
+        "route_stats": (ROUTE_STATS_COLLECTION, group_then_resolve(
+            id={"from_city": "$from_city", "to_city": "$to_city"}, fields=["count"],
+            sort={"count": -1, "_id": 1}, skip=0, limit=5, resolve=route_resolve()
+        ))
+    },
+    "average_duration": {
+        "lookup_then_group": ("flights", route_lookups() + [
+            {"$group": {"_id": {"from_city": "$from_city.name", "to_city": "$to_city.name"}, "avg_duration": {"$avg": "$duration"}}},
+            {"$sort": {"avg_duration": 1}}, {"$skip": 0}, {"$limit": 10}
+        ]),
+        "group_then_resolve": ("flights", group_then_resolve(
+            id={"from_city": "$from_city", "to_city": "$to_city"}, fields=["avg_duration"], group=route_group({"avg_duration": {"$avg": "$duration"}}),
+            sort={"avg_duration": 1, "_id": 1}, skip=0, limit=10, resolve=route_resolve()
+        )),
+        "route_stats": (ROUTE_STATS_COLLECTION, group_then_resolve(
+            id={"from_city": "$from_city", "to_city": "$to_city"}, fields=["avg_duration"],
+            add_fields={"avg_duration": {"$divide": ["$duration_sum", "$duration_count"]}},
+            sort={"avg_duration": 1, "_id": 1}, skip=0, limit=10, resolve=route_resolve()
+        ))
+    }
+}
+
+
+def seed(database, flights, batch_size=10000):
+    database.drop_collection("airlines")
+    database.drop_collection("cities")
+    database.drop_collection("flights")
+    database.drop_collection(ROUTE_STATS_COLLECTION)
+
+    airline_ids = [str(uuid.uuid4()) for _ in airlines]
+    city_ids = [str(uuid.uuid4()) for _ in airports]
+    database["airlines"].insert_many([{"_id": _id, "name": name} for _id, name in zip(airline_ids, airlines)])
+    database["cities"].insert_many([{"_id": _id, "name": name} for _id, name in zip(city_ids, airports)])
+
+    for start in range(0, flights, batch_size):
+        batch = []
+        for _ in range(min(batch_size, flights - start)):
+            from_city_id, to_city_id = random.sample(city_ids, 2)
+            batch.append({
+                "_id": str(uuid.uuid4()),
+                "airline_id": random.choice(airline_ids),
+                "from_city_id": from_city_id,
+                "to_city_id": to_city_id,
+                "month": random.randint(1, 12),
+                "duration": random.randint(25, 1000),
+                "age": random.randint(1, 90)
+            })
+        database["flights"].insert_many(batch, ordered=False)
+
+    database["flights"].aggregate(RouteStats.rebuild_pipeline)
+
+
+def run(database, repeat):
+    results = {}
+    for endpoint, variants in PIPELINES.items():
+        results[endpoint] = {}
+        for variant, (collection, pipeline) in variants.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(database[collection].aggregate(pipeline))
+                timings.append(time.perf_counter() - start)
+            results[endpoint][variant] = statistics.median(timings)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-f", "--flights",
+            help="Amount of flights to seed the benchmark database with, defaults to: 1000000", type=int, default=1000000)
+    parser.add_argument("-r", "--repeat",
+            help="Times each pipeline is run, the median is reported, defaults to: 5", type=int, default=5)
+    parser.add_argument("--no-seed",
+            help="Reuse the flights already in the benchmark database", action="store_true")
+
+    args = parser.parse_args()
+
+    database = MongoClient(MONGODB_URI)[DB_NAME]
+    if not args.no_seed:
+        print(f"Seeding {args.flights} flights into {DB_NAME}")
+        seed(database, args.flights)
+
+    for endpoint, variants in run(database, args.repeat).items():
+        baseline = variants["lookup_then_group"]
+        print(f"=== {endpoint} ===")
+        for variant, seconds in variants.items():
+            print(f"{variant:>20}: {seconds * 1000:10.1f} ms  ({baseline / seconds:.1f}x)")
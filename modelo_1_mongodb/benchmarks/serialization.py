@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Compares the response_model path of GET /flight (Pydantic validation + jsonable_encoder + json)
+with the fast path (documents encoded as they come from Mongo), no database is needed
+Run it from the modelo_1_mongodb directory:
+    python3 -m benchmarks.serialization --limit 1000
+"""
+import argparse
+import random
+import statistics
+import time
+import uuid
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from model import Flight_Search
+from responses import FastJSONResponse, orjson
+
+
+def flight_documents(count):
+    return [
+        {
+            "_id": str(uuid.uuid4()),
+            "airline_id": str(uuid.uuid4()),
+            "from_city_id": str(uuid.uuid4()),
+            "to_city_id": str(uuid.uuid4()),
+            "day": random.randint(1, 28),
+            "month": random.randint(1, 12),
+            "year": random.randint(2013, 2023),
+            "duration": random.randint(25, 1000),
+            "age": random.randint(1, 90),
+            "gender": random.choice(["male", "female", "unspecified", "undisclosed"]),
+            "reason": random.choice(["On vacation/Pleasure", "Business/Work", "Back Home"]),
+            "stay": random.choice(["Hotel", "Short-term homestay", "Home", "Friend/Family"]),
+            "transit": random.choice(["Airport cab", "Car rental", "Pickup", "Own car"]),
+            "connection": random.choice([True, False]),
+            "wait": random.randint(0, 720),
+            "ticket": random.choice(["Economy", "Business", "First Class"]),
+            "checked_bags": random.randint(0, 3),
+            "carry_on": random.choice(["True", "False"])
+        }
+        for _ in range(count)
+    ]
+
+
+def response_model_path(documents):
+    return JSONResponse(jsonable_encoder([Flight_Search(**document) for document in documents], by_alias=True)).body
+
+
+def fast_path(documents):
+    return FastJSONResponse(documents).body
+
+
+def timeit(function, documents, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(documents)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-l", "--limit",
+            help="Amount of flights in the serialized page, defaults to: 1000", type=int, default=1000)
+    parser.add_argument("-r", "--repeat",
+            help="Times each path is run, the median is reported, defaults to: 20", type=int, default=20)
+
+    args = parser.parse_args()
+
+    documents = flight_documents(args.limit)
+    slow = timeit(response_model_path, documents, args.repeat)
+    fast = timeit(fast_path, documents, args.repeat)
+
+    print(f"Encoder: {'orjson' if orjson is not None else 'json'}")
+    print(f"response_model: {slow * 1000:8.2f} ms")
+    print(f"     fast path: {fast * 1000:8.2f} ms  ({slow / fast:.1f}x)")
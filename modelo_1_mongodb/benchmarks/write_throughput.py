@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Load test of POST /flight with and without the read-back of the inserted document
+Run it from the modelo_1_mongodb directory once the API is running and data/populate.py loaded the airlines and cities:
+    python3 -m benchmarks.write_throughput --requests 5000 --concurrency 16
+"""
+import argparse
+import itertools
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from data.flight_data import read_flights
+
+
+FLIGHTS_API_URL = os.getenv("FLIGHTS_API_URL", "http://localhost:8000")
+
+
+def load_flights(path):
+    flights = [flight for _, flight in read_flights(path)]
+    for flight in flights:
+        flight["from_city"] = flight.pop("from")
+    return flights
+
+
+def run(flights, total, concurrency, verify):
+    local = threading.local()
+    rows = itertools.cycle(flights)
+    lock = threading.Lock()
+
+    def post(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        with lock:
+            flight = next(rows)
+        start = time.perf_counter()
+        response = local.session.post(FLIGHTS_API_URL + "/flight/", json=flight, params={"verify": verify})
+        return time.perf_counter() - start, response.ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(post, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "requests": total,
+        "errors": sum(1 for _, ok in results if not ok),
+        "throughput": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-f", "--file",
+            help="CSV, Arrow or Parquet file with the flights to post, defaults to: data/flight_passengers.csv", default="data/flight_passengers.csv")
+    parser.add_argument("-n", "--requests",
+            help="Amount of flights posted in every mode, defaults to: 2000", type=int, default=2000)
+    parser.add_argument("-c", "--concurrency",
+            help="Amount of concurrent clients, defaults to: 8", type=int, default=8)
+
+    args = parser.parse_args()
+
+    flights = load_flights(args.file)
+    results = {verify: run(flights, args.requests, args.concurrency, verify) for verify in (True, False)}
+
+    for verify, result in results.items():
+        print(f"=== verify={str(verify).lower()} ===")
+        for k, v in result.items():
+            print(f"{k}: {v:.1f}" if isinstance(v, float) else f"{k}: {v}")
+    print(f"Speedup without read-back: {results[False]['throughput'] / results[True]['throughput']:.2f}x")
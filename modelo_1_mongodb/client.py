@@ -1,8 +1,12 @@
 import argparse
 import logging
 import os
+import sys
 import requests
 import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 
 # Set logger
@@ -14,6 +18,15 @@ log.addHandler(handler)
 
 # Read env vars related to API connection
 FLIGHTS_API_URL = os.getenv("FLIGHTS_API_URL", "http://localhost:8000")
+# requests run at once when fetching many ids
+CLIENT_WORKERS = int(os.getenv("CLIENT_WORKERS", "8"))
+# seconds to wait for a response
+CLIENT_TIMEOUT = float(os.getenv("CLIENT_TIMEOUT", "30"))
+
+# one pooled session so every request reuses an open connection
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=CLIENT_WORKERS))
+session.mount("https://", HTTPAdapter(pool_maxsize=CLIENT_WORKERS))
 
 
 def print_flight(flight):
@@ -31,83 +44,104 @@ def print_city(city):
         print(f"{k}: {city[k]}")
     print("="*50)
 
+def read_ids(ids):
+    # a - reads whitespace separated ids from stdin, line by line as they are fetched
+    if ids == ["-"]:
+        return (id for line in sys.stdin for id in line.split())
+    return ids
+
+def print_next_cursor(response):
+    if "X-Next-Cursor" in response.headers:
+        print(f"Next page: --after {response.headers['X-Next-Cursor']}")
+
 
-def list_flights(limit, skip):
-    suffix = "/flight"
+def search(suffix, params, print_item, all_pages=False):
     endpoint = FLIGHTS_API_URL + suffix
+    if not all_pages:
+        response = session.get(endpoint, params=params, timeout=CLIENT_TIMEOUT)
+        if response.ok:
+            for item in response.json():
+                print_item(item)
+            print_next_cursor(response)
+        else:
+            print(f"Error: {response}")
+        return
+
+    # walk every page, the next one is requested before the current one is printed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = executor.submit(session.get, endpoint, params=params, timeout=CLIENT_TIMEOUT)
+        while page is not None:
+            response = page.result()
+            if not response.ok:
+                print(f"Error: {response}")
+                return
+            after = response.headers.get("X-Next-Cursor")
+            page = executor.submit(session.get, endpoint, params={**params, "skip": None, "after": after}, timeout=CLIENT_TIMEOUT) if after else None
+            for item in response.json():
+                print_item(item)
+
+def get_many(suffix, ids, print_item, params=None):
+    def get(id):
+        try:
+            return session.get(FLIGHTS_API_URL + suffix + id, params=params, timeout=CLIENT_TIMEOUT)
+        except requests.RequestException as e:
+            return e
+
+    def print_response(id, response):
+        if isinstance(response, requests.Response) and response.ok:
+            print_item(response.json())
+        else:
+            print(f"Error: {response} - {id}")
+
+    # fetched concurrently by the workers, printed in the order the ids were given;
+    # only a window of ids is in flight so long id lists are not all held in memory
+    with ThreadPoolExecutor(max_workers=CLIENT_WORKERS) as executor:
+        pending = deque()
+        for id in ids:
+            pending.append((id, executor.submit(get, id)))
+            if len(pending) > 2 * CLIENT_WORKERS:
+                id, future = pending.popleft()
+                print_response(id, future.result())
+        while pending:
+            id, future = pending.popleft()
+            print_response(id, future.result())
+
+
+def list_flights(limit, skip, after=None, fields=None, all_pages=False):
     params = {
         "limit": limit,
-        "skip": skip
+        "skip": skip,
+        "after": after,
+        "fields": fields
     }
-    response = requests.get(endpoint, params=params)
-    if response.ok:
-        json_resp = response.json()
-        for flight in json_resp:
-            print_flight(flight)
-    else:
-        print(f"Error: {response}")
+    search("/flight/", params, print_flight, all_pages)
 
-def get_flight_by_id(id):
-    suffix = f"/flight/{id}"
-    endpoint = FLIGHTS_API_URL + suffix
-    response = requests.get(endpoint)
-    if response.ok:
-        json_resp = response.json()
-        print_flight(json_resp)
-    else:
-        print(f"Error: {response}")
+def get_flight_by_id(ids, fields=None):
+    get_many("/flight/", ids, print_flight, {"fields": fields})
 
 
-def list_airlines(limit, skip):
-    suffix = "/airline"
-    endpoint = FLIGHTS_API_URL + suffix
+def list_airlines(limit, skip, after=None, all_pages=False):
     params = {
         "limit": limit,
-        "skip": skip
+        "skip": skip,
+        "after": after
     }
-    response = requests.get(endpoint, params=params)
-    if response.ok:
-        json_resp = response.json()
-        for airline in json_resp:
-            print_airline(airline)
-    else:
-        print(f"Error: {response}")
+    search("/airline/", params, print_airline, all_pages)
 
-def get_airline_by_id(id):
-    suffix = f"/airline/{id}"
-    endpoint = FLIGHTS_API_URL + suffix
-    response = requests.get(endpoint)
-    if response.ok:
-        json_resp = response.json()
-        print_airline(json_resp)
-    else:
-        print(f"Error: {response}")
+def get_airline_by_id(ids):
+    get_many("/airline/", ids, print_airline)
 
 
-def list_cities(limit, skip):
-    suffix = "/city"
-    endpoint = FLIGHTS_API_URL + suffix
+def list_cities(limit, skip, after=None, all_pages=False):
     params = {
         "limit": limit,
-        "skip": skip
+        "skip": skip,
+        "after": after
     }
-    response = requests.get(endpoint, params=params)
-    if response.ok:
-        json_resp = response.json()
-        for city in json_resp:
-            print_city(city)
-    else:
-        print(f"Error: {response}")
+    search("/city/", params, print_city, all_pages)
 
-def get_city_by_id(id):
-    suffix = f"/city/{id}"
-    endpoint = FLIGHTS_API_URL + suffix
-    response = requests.get(endpoint)
-    if response.ok:
-        json_resp = response.json()
-        print_city(json_resp)
-    else:
-        print(f"Error: {response}")
+def get_city_by_id(ids):
+    get_many("/city/", ids, print_city)
 
 
 def common_destinations(limit, skip):
@@ -117,7 +151,7 @@ def common_destinations(limit, skip):
         "limit": limit,
         "skip": skip
     }
-    response = requests.get(endpoint, params=params)
+    response = session.get(endpoint, params=params, timeout=CLIENT_TIMEOUT)
     if response.ok:
         json_resp = response.json()
         for flight in json_resp:
@@ -133,7 +167,7 @@ def average_duration(limit, skip):
         "limit": limit,
         "skip": skip
     }
-    response = requests.get(endpoint, params=params)
+    response = session.get(endpoint, params=params, timeout=CLIENT_TIMEOUT)
     if response.ok:
         json_resp = response.json()
         for flight in json_resp:
@@ -149,7 +183,7 @@ def popular_airlines(limit, skip):
         "limit": limit,
         "skip": skip
     }
-    response = requests.get(endpoint, params=params)
+    response = session.get(endpoint, params=params, timeout=CLIENT_TIMEOUT)
     if response.ok:
         json_resp = response.json()
         for flight in json_resp:
@@ -166,12 +200,18 @@ def main():
     list_of_actions = ["search_flights", "get_flight", "search_airlines", "get_airline", "search_cities", "get_city", "common_destinations", "average_duration", "popular_airlines"]
     parser.add_argument("action", choices=list_of_actions,
             help="Action to be user for the flight catalog")
-    parser.add_argument("-i", "--id",
-            help="Provide a flight ID, city ID or airline ID which related to the flight catalog action", default=None)
+    parser.add_argument("-i", "--id", nargs="+",
+            help="Provide one or more flight IDs, city IDs or airline IDs which related to the flight catalog action, - reads them from stdin", default=None)
     parser.add_argument("-l", "--limit",
             help="Limit the number of flights, cities or airlines to be shown", default=None)
     parser.add_argument("-s", "--skip",
             help="Skip the first N flights, cities or airlines", default=None) 
+    parser.add_argument("-f", "--fields",
+            help="Comma separated flight fields to be shown, i.e. from_city_id,to_city_id,day,month,year", default=None)
+    parser.add_argument("-a", "--after",
+            help="Cursor of the page to continue from, printed at the end of every search page", default=None)
+    parser.add_argument("--all", action="store_true",
+            help="Show every page of the search results instead of only one")
 
     args = parser.parse_args()
 
@@ -179,24 +219,40 @@ def main():
         log.error(f"Can't use arg id with action {args.action}")
         exit(1)
 
+    if not args.id and args.action in ["get_flight", "get_airline", "get_city"]:
+        log.error(f"Action {args.action} needs at least one id")
+        exit(1)
+
+    if args.fields and not args.action in ["search_flights", "get_flight"]:
+        log.error("Fields arg can only be used with search_flights and get_flight actions")
+        exit(1)
+
+    if args.after and not args.action in ["search_flights", "search_airlines", "search_cities"]:
+        log.error("After arg can only be used with search action")
+        exit(1)
+
+    if args.all and not args.action in ["search_flights", "search_airlines", "search_cities"]:
+        log.error("All arg can only be used with search action")
+        exit(1)
+
     if (args.limit or args.skip) and not args.action in ["search_flights", "search_airlines", "search_cities", "common_destinations", "average_duration", "popular_airlines"]:
         log.error(f"Limit, and skip arg can only be used with search action")
         exit(1)
 
     if args.action == "search_flights": # get list of flights
-        list_flights(args.limit, args.skip)
+        list_flights(args.limit, args.skip, args.after, args.fields, args.all)
     elif args.action == "get_flight": # get flight by id
-        get_flight_by_id(args.id)
+        get_flight_by_id(read_ids(args.id), args.fields)
 
     elif args.action == "search_airlines": # get id of airlines
-        list_airlines(args.limit, args.skip)
+        list_airlines(args.limit, args.skip, args.after, args.all)
     elif args.action == "get_airline": # get stats for airline by id (impotant for my solution)
-        get_airline_by_id(args.id)
+        get_airline_by_id(read_ids(args.id))
 
     elif args.action == "search_cities": # get list of cities
-        list_cities(args.limit, args.skip)
+        list_cities(args.limit, args.skip, args.after, args.all)
     elif args.action == "get_city": # get stats for city by id (important for my solution)
-        get_city_by_id(args.id)
+        get_city_by_id(read_ids(args.id))
 
     elif args.action == "common_destinations": # get common destinations (extra feature)
         common_destinations(args.limit, args.skip)
@@ -2,13 +2,17 @@
 
 """
 Generador de datos para proyecto de Bases de Datos No Relacionales
-ITESO 
+ITESO
 """
 import argparse
 import csv
-import datetime
+import itertools
+import os
+import string
+from collections import namedtuple
+from multiprocessing import Pool
 
-from random import choice, randint, randrange
+import numpy as np
 
 
 airlines = ["American Airlines", "Delta Airlines", "Alaska", "Aeromexico", "Volaris"]
@@ -21,61 +25,261 @@ tickets = ["Economy", "Business", "First Class"]
 connections = [True, False]
 carry_on = [True, False]
 
+fieldnames = ["airline", "from" , "to", "day", "month", "year", "duration", "age", "gender", "reason", "stay", "transit", "connection", "wait", "ticket", "checked_bags", "carry_on"]
+FORMATS = ["csv", "arrow", "parquet"]
+# typed columnar files keep the generated types, in the narrowest integers holding their values
+INT_TYPES = {"day": "int8", "month": "int8", "year": "int16", "duration": "int16", "age": "int8", "wait": "int16", "checked_bags": "int8"}
+ARROW_EXTENSIONS = [".arrow", ".ipc", ".feather"]
+START_DATE = np.datetime64("2013-01-01")
+END_DATE = np.datetime64("2023-04-25")
 
-def random_date(start_date, end_date):
-    time_between_dates = end_date - start_date
-    days_between_dates = time_between_dates.days
-    random_number_of_days = randrange(days_between_dates)
-    rand_date = start_date + datetime.timedelta(days=random_number_of_days)
-    return rand_date
-
-
-def generate_dataset(output_file, rows):
-    with open(output_file, "w") as fd:
-        fieldnames = ["airline", "from" , "to", "day", "month", "year", "duration", "age", "gender", "reason", "stay", "transit", "connection", "wait", "ticket", "checked_bags", "carry_on"]
-        fp_dict = csv.DictWriter(fd, fieldnames=fieldnames)
-        fp_dict.writeheader()
-        for i in range(rows):
-            from_airport = choice(airports)
-            to_airport = choice(airports)
-            while from_airport == to_airport:
-                to_airport = choice(airports)
-            date = random_date(datetime.datetime(2013, 1, 1), datetime.datetime(2023, 4, 25))
-            reason = choice(reasons)
-            stay = choice(stays)
-            connection = choice(connections)
-            wait = randint(30, 720)
-            transit = choice(transits)
-            if not connection:
-               wait = 0
-            else:
-                transit = ""
-            if reason == "Back Home":
-                stay = "Home"
-                connection = False
-                wait = 0
-                transit = choice(transits)
-                
-            line = {
-                "airline": choice(airlines),
-                "from":  from_airport,
-                "to":  to_airport,
-                "day": date.day,
-                "month": date.month,
-                "year": date.year,
-                "duration": randint(25, 1000),
-                "age": randint(1,90),
-                "gender": choice(genders),
-                "reason": reason,
-                "stay": stay,
-                "transit": transit,
-                "connection": connection,
-                "wait": wait,
-                "ticket": choice(tickets),
-                "checked_bags": randint(0, 3),
-                "carry_on": choice(carry_on),
-            }
-            fp_dict.writerow(line)
+# catalog sizes, Zipf exponent of the airport and airline popularity (0 is uniform),
+# seasonal month weighting and the seed used when none is given
+PROFILES = {
+    "uniform": {"cities": 5, "airline_count": 5, "zipf": 0.0, "seasonal": False, "seed": None},
+    "skewed": {"cities": 1000, "airline_count": 50, "zipf": 1.1, "seasonal": True, "seed": 42},
+    "hot-routes": {"cities": 5000, "airline_count": 200, "zipf": 1.5, "seasonal": True, "seed": 42},
+}
+# relative number of flights per month, peaking on the summer and december holidays
+SEASONAL_MONTHS = [0.8, 0.75, 0.9, 0.95, 1.0, 1.2, 1.4, 1.35, 0.9, 0.85, 0.9, 1.3]
+MAX_CITIES = 26 ** 3
+
+Workload = namedtuple("Workload", ["airlines", "airports", "airline_weights", "airport_weights", "day_weights"])
+
+
+def zipf_weights(size, exponent):
+    if exponent == 0:
+        return None
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def make_workload(cities=5, airline_count=5, zipf=0.0, seasonal=False):
+    """Catalogs and sampling weights of a dataset, the first entries of a catalog are its most popular ones."""
+    if not 2 <= cities <= MAX_CITIES:
+        raise ValueError(f"Cities must be between 2 and {MAX_CITIES}")
+    if airline_count < 1:
+        raise ValueError("Airlines must be at least 1")
+
+    # the original airports and airlines first, then made up codes and names in a fixed order
+    codes = ("".join(code) for code in itertools.product(string.ascii_uppercase, repeat=3))
+    extra_airports = np.random.default_rng(0).permutation([code for code in codes if code not in airports])
+    airport_catalog = (airports + extra_airports[:max(cities - len(airports), 0)].tolist())[:cities]
+    airline_catalog = (airlines + [f"Airline {i:04d}" for i in range(len(airlines) + 1, airline_count + 1)])[:airline_count]
+
+    day_weights = None
+    if seasonal:
+        days = np.arange(START_DATE, END_DATE)
+        day_weights = np.array(SEASONAL_MONTHS)[days.astype("datetime64[M]").astype(int) % 12]
+        day_weights = day_weights / day_weights.sum()
+
+    return Workload(airline_catalog, airport_catalog, zipf_weights(airline_count, zipf), zipf_weights(cities, zipf), day_weights)
+
+
+DEFAULT_WORKLOAD = make_workload()
+
+
+# categorical columns are generated as codes into their values and only decoded when written
+Categorical = namedtuple("Categorical", ["codes", "values"])
+
+
+def generate_chunk(rng, rows, workload=DEFAULT_WORKLOAD):
+    """One column per field for rows random flights of the workload, drawn with the rng."""
+    choice = lambda values: Categorical(rng.integers(len(values), size=rows), values)
+
+    catalog = workload.airports
+    if workload.airport_weights is None:
+        # a different destination without the rejection loop: shift the origin by 1..n-1 airports
+        from_code = rng.integers(len(catalog), size=rows)
+        to_code = (from_code + rng.integers(1, len(catalog), size=rows)) % len(catalog)
+    else:
+        from_code = rng.choice(len(catalog), size=rows, p=workload.airport_weights)
+        to_code = rng.choice(len(catalog), size=rows, p=workload.airport_weights)
+        # only the rows drawn to their own origin are drawn again
+        same = np.flatnonzero(from_code == to_code)
+        while len(same):
+            to_code[same] = rng.choice(len(catalog), size=len(same), p=workload.airport_weights)
+            same = same[from_code[same] == to_code[same]]
+
+    days = (END_DATE - START_DATE).astype(int)
+    dates = START_DATE + (rng.integers(days, size=rows) if workload.day_weights is None else rng.choice(days, size=rows, p=workload.day_weights))
+    months = dates.astype("datetime64[M]")
+
+    reason = choice(reasons)
+    stay = choice(stays)
+    connection = rng.integers(2, size=rows).astype(bool)
+    wait = rng.integers(30, 721, size=rows)
+    # the extra last value is the empty transit of flights with a connection
+    transit = Categorical(rng.integers(len(transits), size=rows), transits + [""])
+
+    # without connection there is no wait, with one there is no ground transit
+    wait[~connection] = 0
+    transit.codes[connection] = len(transits)
+    # going back home always means staying home on a direct flight, with ground transit
+    back_home = reason.codes == reasons.index("Back Home")
+    stay.codes[back_home] = stays.index("Home")
+    connection[back_home] = False
+    wait[back_home] = 0
+    transit.codes[back_home] = rng.integers(len(transits), size=rows)[back_home]
+
+    return {
+        "airline": Categorical(
+            rng.integers(len(workload.airlines), size=rows) if workload.airline_weights is None
+            else rng.choice(len(workload.airlines), size=rows, p=workload.airline_weights),
+            workload.airlines
+        ),
+        "from": Categorical(from_code, catalog),
+        "to": Categorical(to_code, catalog),
+        "day": (dates - months).astype(int) + 1,
+        "month": months.astype(int) % 12 + 1,
+        "year": dates.astype("datetime64[Y]").astype(int) + 1970,
+        "duration": rng.integers(25, 1001, size=rows),
+        "age": rng.integers(1, 91, size=rows),
+        "gender": choice(genders),
+        "reason": reason,
+        "stay": stay,
+        "transit": transit,
+        "connection": connection,
+        "wait": wait,
+        "ticket": choice(tickets),
+        "checked_bags": rng.integers(0, 4, size=rows),
+        "carry_on": rng.integers(2, size=rows).astype(bool),
+    }
+
+
+def _strings(column):
+    # every column holds few distinct values, so its text comes from a lookup table
+    if isinstance(column, Categorical):
+        return np.array(column.values, dtype=object)[column.codes].tolist()
+    if column.dtype == bool:
+        return np.array(["False", "True"], dtype=object)[column.astype(int)].tolist()
+    if len(column) == 0:
+        return []
+    return np.array([str(value) for value in range(column.max() + 1)], dtype=object)[column].tolist()
+
+
+def encode_csv(columns):
+    text = [_strings(columns[field]) for field in fieldnames]
+    return ("\n".join(map(",".join, zip(*text))) + "\n").encode()
+
+
+def encode_arrow(columns):
+    import pyarrow as pa
+
+    arrays = []
+    for field in fieldnames:
+        column = columns[field]
+        if isinstance(column, Categorical):
+            # dictionary encoded, the codes index the values written once per batch
+            arrays.append(pa.DictionaryArray.from_arrays(column.codes.astype(np.int32), pa.array(column.values, pa.string())))
+        elif column.dtype == bool:
+            arrays.append(pa.array(column))
+        else:
+            arrays.append(pa.array(column.astype(INT_TYPES[field])))
+    return pa.record_batch(arrays, names=fieldnames)
+
+
+def read_flights(path, offset=0):
+    """Yield (position, flight) for the flights of a csv, Arrow IPC or Parquet file from the offset row on.
+
+    CSV values are strings, the columnar files give ints, bools and strings and skip whole
+    batches before the offset without decoding them. Arrow files are memory mapped.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ARROW_EXTENSIONS + [".parquet"]:
+        with open(path, newline="") as fd:
+            for position, flight in enumerate(csv.DictReader(fd)):
+                if position >= offset:
+                    yield position, flight
+        return
+
+    if extension == ".parquet":
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        sizes = [parquet.metadata.row_group(i).num_rows for i in range(parquet.num_row_groups)]
+        batches = ((size, lambda i=i: parquet.read_row_group(i)) for i, size in enumerate(sizes))
+    else:
+        import pyarrow as pa
+
+        reader = pa.ipc.open_file(pa.memory_map(path))
+        batches = ((reader.get_batch(i).num_rows, lambda i=i: reader.get_batch(i)) for i in range(reader.num_record_batches))
+
+    position = 0
+    for size, read in batches:
+        if position + size > offset:
+            start = max(offset - position, 0)
+            for i, flight in enumerate(_rows(read().slice(start))):
+                yield position + start + i, flight
+        position += size
+
+
+def _rows(batch):
+    # decode column by column, dictionary columns through their few values
+    columns = []
+    for column in batch.columns:
+        if hasattr(column, "chunks"):
+            column = column.combine_chunks()
+        if hasattr(column, "dictionary"):
+            columns.append(np.array(column.dictionary.to_pylist(), dtype=object)[column.indices.to_numpy()].tolist())
+        else:
+            columns.append(column.to_numpy(zero_copy_only=False).tolist())
+    names = batch.schema.names
+    return (dict(zip(names, row)) for row in zip(*columns))
+
+
+def _generate_shard(task):
+    seed, rows, workload, output_format = task
+    columns = generate_chunk(np.random.default_rng(seed), rows, workload)
+    return encode_csv(columns) if output_format == "csv" else encode_arrow(columns)
+
+
+def generate_dataset(output_file, rows, seed=None, workers=1, chunk_size=100_000, output_format="csv", workload=DEFAULT_WORKLOAD):
+    """Write rows random flights in chunks of chunk_size generated by workers processes.
+
+    Every chunk gets its own seed spawned from seed, so the same seed gives the same
+    dataset whatever the number of workers.
+    """
+    chunks = [min(chunk_size, rows - start) for start in range(0, rows, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks = [(chunk_seed, chunk_rows, workload, output_format) for chunk_seed, chunk_rows in zip(seeds, chunks)]
+
+    with Pool(workers) if workers > 1 else _InProcess() as pool:
+        # chunks are written in order as soon as they are generated
+        shards = pool.imap(_generate_shard, tasks)
+        if output_format == "csv":
+            with open(output_file, "wb") as fd:
+                fd.write((",".join(fieldnames) + "\n").encode())
+                for shard in shards:
+                    fd.write(shard)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            writer = None
+            for shard in shards:
+                if writer is None:
+                    # every chunk is a record batch of the Arrow file or a row group of the Parquet one
+                    writer = pa.ipc.new_file(output_file, shard.schema) if output_format == "arrow" else pq.ParquetWriter(output_file, shard.schema)
+                if output_format == "arrow":
+                    writer.write_batch(shard)
+                else:
+                    writer.write_table(pa.Table.from_batches([shard]))
+            if writer is not None:
+                writer.close()
+
+
+class _InProcess:
+    """Pool stand-in generating the chunks in this process when a single worker is asked for."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def imap(self, func, iterable):
+        return map(func, iterable)
 
 
 if __name__ == "__main__":
@@ -85,11 +289,36 @@ if __name__ == "__main__":
             help="Specify the output filename of your csv, defaults to: flight_passengers.csv", default="flight_passengers.csv")
     parser.add_argument("-r", "--rows",
             help="Amount of random generated entries for the dataset, defaults to: 100", type=int, default=100)
+    parser.add_argument("-s", "--seed",
+            help="Seed of the random generator, the same seed generates the same dataset, defaults to the seed of the profile", type=int, default=None)
+    parser.add_argument("-p", "--profile", choices=list(PROFILES),
+            help="Workload profile setting the catalog sizes, skew and seasonality, defaults to: uniform", default="uniform")
+    parser.add_argument("--cities",
+            help="Number of airports, overrides the profile", type=int, default=None)
+    parser.add_argument("--airlines",
+            help="Number of airlines, overrides the profile", type=int, default=None)
+    parser.add_argument("--zipf",
+            help="Zipf exponent of the airport and airline popularity, 0 draws them uniformly, overrides the profile", type=float, default=None)
+    parser.add_argument("--seasonal", action=argparse.BooleanOptionalAction,
+            help="Weight the flight dates by month, overrides the profile", default=None)
+    parser.add_argument("-w", "--workers",
+            help="Processes generating the dataset, defaults to the number of CPUs", type=int, default=os.cpu_count())
+    parser.add_argument("-c", "--chunk-size",
+            help="Rows generated at once by a worker, defaults to: 100000", type=int, default=100_000)
+    parser.add_argument("-f", "--format", choices=FORMATS,
+            help="Output format, csv or a typed Arrow IPC or Parquet file with dictionary encoded categories (needs pyarrow), defaults to: csv", default="csv")
 
     args = parser.parse_args()
-    
-    print(f"Generating {args.rows} for flight passenger dataset")
-    generate_dataset(args.output, args.rows)
-    print(f"Completed generating dataset in {args.output}")
 
+    profile = dict(PROFILES[args.profile])
+    seed = profile.pop("seed") if args.seed is None else args.seed
+    overrides = {"cities": args.cities, "airline_count": args.airlines, "zipf": args.zipf, "seasonal": args.seasonal}
+    profile.update({name: value for name, value in overrides.items() if value is not None})
+    try:
+        workload = make_workload(**{name: value for name, value in profile.items() if name != "seed"})
+    except ValueError as e:
+        parser.error(str(e))
 
+    print(f"Generating {args.rows} for flight passenger dataset ({args.profile} profile, seed {seed})")
+    generate_dataset(args.output, args.rows, seed, args.workers, args.chunk_size, args.format, workload)
+    print(f"Completed generating dataset in {args.output}")
@@ -1,58 +1,267 @@
-import csv
+import argparse
+import json
+import os
+import random
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from flight_data import read_flights
+
+BASE_URL = os.getenv("FLIGHTS_API_URL", "http://localhost:8000")
+# responses worth retrying, anything else is reported as is
+RETRY_STATUS = {429, 502, 503, 504}
+# a flight with the _id of a row already loaded is rejected with this error
+DUPLICATE_KEY_ERROR = "E11000"
+
+
+class Loader:
+    """Posts the flights of a CSV file to the API in batches from a pool of threads sharing one session."""
+
+    def __init__(self, base_url, concurrency, retries, backoff, timeout):
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # fall back to one request per flight when the API has no bulk endpoint
+        self.bulk = True
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, suffix, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, self.base_url + suffix, timeout=self.timeout, **kwargs)
+                if response.status_code not in RETRY_STATUS:
+                    return response
+            # retrying is safe, a replayed flight has the _id of its row and is rejected as a duplicate
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            if attempt < self.retries:
+                # exponential backoff with jitter so the threads do not retry in lockstep
+                time.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+        return response
+
+    def existing_names(self, suffix):
+        names = set()
+        after = None
+        while True:
+            params = {"limit": 1000}
+            if after is not None:
+                params["after"] = after
+            response = self.request("GET", suffix, params=params)
+            response.raise_for_status()
+            names |= {document["name"] for document in response.json()}
+            after = response.headers.get("X-Next-Cursor")
+            if after is None:
+                return names
+
+    def post_name(self, suffix, name):
+        response = self.request("POST", suffix, json={"name": name})
+        # 409 is a name posted meanwhile
+        if not response.ok and response.status_code != 409:
+            print(f"Failed to post {suffix.strip('/')} {response} - {name}")
+
+    def post_flights(self, flights):
+        """Post a batch, returns the number of inserted and already loaded flights and the errors by position in the batch."""
+        if self.bulk:
+            body = "\n".join(json.dumps(flight) for flight in flights)
+            response = self.request("POST", "/flight/bulk", data=body.encode(), headers={"Content-Type": "application/x-ndjson"})
+            if response.status_code in (404, 405):
+                self.bulk = False
+            else:
+                response.raise_for_status()
+                result = response.json()
+                errors = [(error["index"], error["error"]) for error in result["errors"]]
+                duplicates = [error for error in errors if DUPLICATE_KEY_ERROR in str(error[1])]
+                return result["inserted"], len(duplicates), [error for error in errors if error not in duplicates]
+
+        inserted = 0
+        duplicates = 0
+        errors = []
+        for position, flight in enumerate(flights):
+            response = self.request("POST", "/flight/", json=flight)
+            if response.ok:
+                inserted += 1
+            elif response.status_code == 409:
+                duplicates += 1
+            else:
+                errors.append((position, f"{response} {response.text}"))
+        return inserted, duplicates, errors
+
+
+def file_identity(path):
+    """Absolute path and size of the loaded file, the checkpoint and flight ids belong to it."""
+    return {"file": os.path.realpath(path), "size": os.path.getsize(path)}
+
+
+def flight_ids(identity):
+    # the flight of a row always gets the same _id, so posting it again is rejected instead of duplicated
+    namespace = uuid.uuid5(uuid.NAMESPACE_URL, f"file://{identity['file']}?size={identity['size']}")
+    return lambda position: str(uuid.uuid5(namespace, str(position)))
+
+
+def read_checkpoint(path, identity):
+    """Rows [0, offset) and the [start, end) ranges in done of the identified file were already loaded."""
+    if path and os.path.exists(path):
+        with open(path) as fd:
+            checkpoint = json.load(fd)
+        if {"file": checkpoint.get("file"), "size": checkpoint.get("size")} == identity:
+            return checkpoint["offset"], {start: end for start, end in checkpoint["done"]}
+        print(f"Ignoring the checkpoint {path} of {checkpoint.get('file')}, it does not belong to {identity['file']}")
+    return 0, {}
+
+
+def write_checkpoint(path, identity, offset, done):
+    if not path:
+        return
+    with open(path + ".tmp", "w") as fd:
+        json.dump({**identity, "offset": offset, "done": sorted(done.items())}, fd)
+    os.replace(path + ".tmp", path)
+
+
+def remove_checkpoint(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def batches(path, batch_size, offset, done, flight_id):
+    """Single pass over the file yielding (start row, flights) batches of contiguous rows not loaded yet."""
+    skip = sorted(done.items())
+    batch = []
+    start = offset
+    for position, flight in read_flights(path, offset):
+        while skip and skip[0][1] <= position:
+            skip.pop(0)
+        if skip and skip[0][0] <= position:
+            if batch:
+                yield start, batch
+                batch = []
+            continue
+
+        if not batch:
+            start = position
+        # change from property to from_city
+        flight["from_city"] = flight.pop("from")
+        flight["_id"] = flight_id(position)
+        batch.append(flight)
+        if len(batch) == batch_size:
+            yield start, batch
+            batch = []
+    if batch:
+        yield start, batch
+
+
+def load(args):
+    loader = Loader(args.url, args.concurrency, args.retries, args.backoff, args.timeout)
+    identity = file_identity(args.file)
+    offset, done = (0, {}) if args.restart else read_checkpoint(args.checkpoint, identity)
+    if offset or done:
+        print(f"Resuming after row {offset} ({len(done)} batches past it already loaded)")
+
+    # names already in the API are not posted again, e.g. when resuming
+    airlines = loader.existing_names("/airline/")
+    cities = loader.existing_names("/city/")
+
+    inserted = 0
+    duplicates = 0
+    failed = 0
+    started = time.monotonic()
+    reported = started
+    pending = {}
+    stopped = False
+
+    def finish(future):
+        nonlocal offset, inserted, duplicates, failed, stopped
+        start, end = pending.pop(future)
+        try:
+            batch_inserted, batch_duplicates, errors = future.result()
+        except requests.RequestException as e:
+            # leave the batch out of the checkpoint, a resumed run posts it again
+            print(f"Failed to post rows {start}-{end - 1}: {e}")
+            stopped = True
+            return
+        inserted += batch_inserted
+        duplicates += batch_duplicates
+        failed += len(errors)
+        for position, error in errors[:5]:
+            print(f"Failed to post flight at row {start + position} - {error}")
+        if len(errors) > 5:
+            print(f"... and {len(errors) - 5} more failed flights in rows {start}-{end - 1}")
+
+        # the checkpoint offset only moves over batches finished without a gap before them
+        done[start] = end
+        while offset in done:
+            offset = done.pop(offset)
+        write_checkpoint(args.checkpoint, identity, offset, done)
+
+    def report(final=False):
+        nonlocal reported
+        now = time.monotonic()
+        if final or now - reported >= args.progress:
+            reported = now
+            print(f"{inserted} flights loaded, {duplicates} already loaded, {failed} failed, {inserted / max(now - started, 1e-9):.0f} flights/s")
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for start, flights in batches(args.file, args.batch_size, offset, done, flight_ids(identity)):
+            if stopped:
+                break
+            # airlines and cities have to exist before the flights referencing them are posted
+            new_airlines = {flight["airline"] for flight in flights} - airlines
+            new_cities = {flight["from_city"] for flight in flights} | {flight["to"] for flight in flights}
+            new_cities -= cities
+            list(executor.map(lambda name: loader.post_name("/airline/", name), new_airlines))
+            list(executor.map(lambda name: loader.post_name("/city/", name), new_cities))
+            airlines |= new_airlines
+            cities |= new_cities
+
+            # keep a bounded number of batches in flight so the file is never read ahead too far
+            while len(pending) >= args.concurrency:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future)
+                report()
+            pending[executor.submit(loader.post_flights, flights)] = (start, start + len(flights))
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                finish(future)
+            report()
+
+    report(final=True)
+    if stopped:
+        print(f"Stopped on a failed batch, run again to resume from the checkpoint {args.checkpoint}")
+        exit(1)
+    # the whole file went through, a later run starts over
+    remove_checkpoint(args.checkpoint)
 
-BASE_URL = "http://localhost:8000"
-
-def arlines():
-    with open("flight_passengers.csv") as fd:
-        flight_passenger_csv = csv.DictReader(fd)
-        # create a set of airlines to avoid duplicates in the database
-        airlines = set()
-
-        # get all airlines
-        for flight in flight_passenger_csv:
-            airlines.add(flight["airline"])
-
-        # for each airline, post it to the API
-        for airline in airlines:
-            x = requests.post(BASE_URL+"/airline", json={"name": airline})
-            if not x.ok:
-                print(f"Failed to post airline {x} - {airline}")
-
-
-def cities():
-    with open("flight_passengers.csv") as fd:
-        flight_passenger_csv = csv.DictReader(fd)
-        # create a set of cities to avoid duplicates in the database
-        cities = set()
-
-        # get all cities
-        for flight in flight_passenger_csv:
-            cities.add(flight["from"])
-            cities.add(flight["to"])
-        
-        # for each city, post it to the API
-        for city in cities:
-            x = requests.post(BASE_URL+"/city", json={"name": city})
-            if not x.ok:
-                print(f"Failed to post city {x} - {city}")
-
-
-def flights():
-    with open("flight_passengers.csv") as fd:
-        flight_passenger_csv = csv.DictReader(fd)
-        for flight in flight_passenger_csv:
-            # change from property to from_city
-            flight["from_city"] = flight.pop("from")
-
-            x = requests.post(BASE_URL+"/flight", json=flight)
-            if not x.ok:
-                print(f"Failed to post flight {x} - {flight}")
 
 def main():
-    arlines()
-    cities()
-    flights()
+    parser = argparse.ArgumentParser(description="Load a flight passengers file through the API")
+    parser.add_argument("-f", "--file", default="flight_passengers.csv", help="CSV, Arrow IPC (.arrow) or Parquet (.parquet) file to load")
+    parser.add_argument("-u", "--url", default=BASE_URL, help="API base url")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000, help="Flights posted per bulk request")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("-r", "--retries", type=int, default=5, help="Retries of a request on connection errors, timeouts or 429/502/503/504")
+    parser.add_argument("--backoff", type=float, default=0.5, help="Seconds before the first retry, doubled on every retry")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a response before retrying the request")
+    parser.add_argument("--checkpoint", default="populate.checkpoint", help="File recording the loaded rows, empty to disable")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and load the file from its first row")
+    parser.add_argument("--progress", type=float, default=5, help="Seconds between progress reports")
+    args = parser.parse_args()
+
+    if args.batch_size < 1 or args.concurrency < 1:
+        print("Batch size and concurrency must be at least 1")
+        exit(1)
+
+    load(args)
 
 
 if __name__ == "__main__":
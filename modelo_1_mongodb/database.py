@@ -0,0 +1,106 @@
+import itertools
+from collections import deque
+
+from fastapi.concurrency import run_in_threadpool
+
+
+class ThreadedCursor:
+    """Motor-like cursor over a pymongo cursor, its I/O runs in the threadpool."""
+
+    def __init__(self, open_cursor):
+        self._open_cursor = open_cursor
+        self._chain = []
+        self._cursor = None
+        self._batch_size = 100
+        self._buffer = deque()
+
+    def sort(self, *args, **kwargs):
+        self._chain.append(("sort", args, kwargs))
+        return self
+
+    def skip(self, *args, **kwargs):
+        self._chain.append(("skip", args, kwargs))
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._chain.append(("limit", args, kwargs))
+        return self
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size or self._batch_size
+        self._chain.append(("batch_size", (batch_size,), {}))
+        return self
+
+    def _open(self):
+        # aggregate runs as soon as it is called, so the pymongo cursor is only built inside the threadpool
+        if self._cursor is None:
+            cursor = self._open_cursor()
+            for name, args, kwargs in self._chain:
+                cursor = getattr(cursor, name)(*args, **kwargs)
+            self._cursor = cursor
+        return self._cursor
+
+    def _next_batch(self, length):
+        return list(itertools.islice(self._open(), length))
+
+    async def to_list(self, length=None):
+        documents = list(self._buffer)
+        self._buffer.clear()
+        if length is not None:
+            length = max(length - len(documents), 0)
+        return documents + await run_in_threadpool(self._next_batch, length)
+
+    async def explain(self):
+        return await run_in_threadpool(lambda: self._open().explain())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            self._buffer.extend(await run_in_threadpool(self._next_batch, self._batch_size))
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.popleft()
+
+
+class ThreadedCollection:
+    """Motor-like collection over a pymongo collection, its I/O runs in the threadpool."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return ThreadedCursor(lambda: self.collection.find(*args, **kwargs))
+
+    def aggregate(self, *args, **kwargs):
+        return ThreadedCursor(lambda: self.collection.aggregate(*args, **kwargs))
+
+    def list_indexes(self, *args, **kwargs):
+        return ThreadedCursor(lambda: self.collection.list_indexes(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def run(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+
+        return run
+
+
+class ThreadedDatabase:
+    """Motor-like database over a pymongo database, so the routes are written once for both drivers."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, name):
+        return ThreadedCollection(self.database[name])
+
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+
+        async def run(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+
+        return run
@@ -0,0 +1,127 @@
+import asyncio
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+
+# indexes each route needs, declared per collection
+INDEXES = {
+    # flight pages are sorted by _id, so _id follows the equality keys and comes before the year and month
+    # ranges, which are then checked on the index keys without breaking the _id order
+    "flights": [
+        {
+            "index": IndexModel([("from_city_id", ASCENDING), ("to_city_id", ASCENDING), ("_id", ASCENDING), ("year", ASCENDING), ("month", ASCENDING)], name="from_city_id_1_to_city_id_1__id_1_year_1_month_1"),
+            "routes": ["GET /flight/?from_city&to_city"]
+        },
+        {
+            "index": IndexModel([("from_city_id", ASCENDING), ("_id", ASCENDING), ("year", ASCENDING), ("month", ASCENDING)], name="from_city_id_1__id_1_year_1_month_1"),
+            "routes": ["GET /city/{id}", "GET /flight/?from_city"]
+        },
+        {
+            "index": IndexModel([("to_city_id", ASCENDING), ("_id", ASCENDING), ("year", ASCENDING), ("month", ASCENDING)], name="to_city_id_1__id_1_year_1_month_1"),
+            "routes": ["GET /flight/?to_city"]
+        },
+        {
+            "index": IndexModel([("airline_id", ASCENDING), ("_id", ASCENDING), ("year", ASCENDING), ("month", ASCENDING)], name="airline_id_1__id_1_year_1_month_1"),
+            "routes": ["GET /airline/{id}", "GET /flight/?airline"]
+        }
+    ],
+    "flight_timeseries": [
+        {
+            "index": IndexModel([("_id.from_city_id", ASCENDING), ("_id.to_city_id", ASCENDING)], name="_id.from_city_id_1__id.to_city_id_1"),
+            "routes": ["GET /flight/timeseries?from_city&to_city&city"]
+        },
+        {
+            "index": IndexModel([("_id.to_city_id", ASCENDING)], name="_id.to_city_id_1"),
+            "routes": ["GET /flight/timeseries?to_city&city"]
+        },
+        {
+            "index": IndexModel([("_id.airline_id", ASCENDING)], name="_id.airline_id_1"),
+            "routes": ["GET /flight/timeseries?airline"]
+        }
+    ],
+    "cities": [
+        {
+            "index": IndexModel([("name", ASCENDING)], name="name_1", unique=True),
+            "routes": ["POST /flight"]
+        }
+    ],
+    "airlines": [
+        {
+            "index": IndexModel([("name", ASCENDING)], name="name_1", unique=True),
+            "routes": ["POST /flight"]
+        }
+    ]
+}
+
+# indexes an earlier version created that are now unused or replaced by the ones above
+OBSOLETE_INDEXES = {
+    "flights": [
+        "airline_id_1",
+        "from_city_id_1",
+        "from_city_id_1_to_city_id_1_month_1",
+        "from_city_id_1_to_city_id_1_year_1_month_1",
+        "airline_id_1_year_1_month_1",
+        "to_city_id_1",
+        "from_city_id_1_to_city_id_1_year_1_month_1__id_1",
+        "airline_id_1_year_1_month_1__id_1"
+    ]
+}
+
+
+class IndexManager:
+    """Creates the declared indexes and reports which ones exist."""
+
+    def __init__(self, database, indexes=INDEXES, obsolete=OBSOLETE_INDEXES):
+        self.database = database
+        self.indexes = indexes
+        self.obsolete = obsolete
+        self.state = "pending"
+        self.errors = {}
+        self._task = None
+
+    async def ensure_indexes(self):
+        # create_indexes is a no-op for indexes that already exist with the same spec
+        self.state = "building"
+        for collection, declared in self.indexes.items():
+            try:
+                await self.database[collection].create_indexes([entry["index"] for entry in declared])
+            except PyMongoError as e:
+                self.errors[collection] = str(e)
+        for collection, names in self.obsolete.items():
+            try:
+                existing = {index["name"] for index in await self.database[collection].list_indexes().to_list(length=None)}
+                for name in existing.intersection(names):
+                    await self.database[collection].drop_index(name)
+            except PyMongoError as e:
+                self.errors[collection] = str(e)
+        self.state = "failed" if self.errors else "ready"
+
+    def ensure_indexes_in_background(self):
+        self._task = asyncio.get_running_loop().create_task(self.ensure_indexes())
+        return self._task
+
+    async def status(self):
+        indexes = []
+        unindexed_routes = set()
+        for collection, declared in self.indexes.items():
+            existing = {index["name"] for index in await self.database[collection].list_indexes().to_list(length=None)}
+            for entry in declared:
+                name = entry["index"].document["name"]
+                exists = name in existing
+                if not exists:
+                    unindexed_routes.update(entry["routes"])
+                indexes.append({
+                    "collection": collection,
+                    "name": name,
+                    "keys": dict(entry["index"].document["key"]),
+                    "exists": exists,
+                    "routes": entry["routes"]
+                })
+
+        return {
+            "state": self.state,
+            "errors": self.errors,
+            "indexes": indexes,
+            "unindexed_routes": sorted(unindexed_routes)
+        }
@@ -3,21 +3,77 @@ import os
 from fastapi import FastAPI
 from pymongo import MongoClient
 
+from database import ThreadedDatabase
+from indexes import IndexManager
+from metrics import Metrics, MongoMonitor, RouteTimingMiddleware
+from name_cache import NameCache
+from profiling import ProfilingMiddleware
+from response_cache import LRUTTLBackend, ResponseCache
+from rollups import FlightTimeSeries, RouteStats
 from routes.airline_routes import router as airline_router
+from routes.cache_routes import router as cache_router
 from routes.city_routes import router as city_router
 from routes.flight_routes import router as flight_router
+from routes.index_routes import router as index_router
+from routes.metrics_routes import router as metrics_router
 
 
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
+# pymongo (blocking calls run in the threadpool) or motor (native asyncio driver)
+MONGODB_DRIVER = os.getenv('MONGODB_DRIVER', 'pymongo')
 DB_NAME = os.getenv('MONGODB_DB_NAME', 'flight_passenger')
+NAME_CACHE_SIZE = int(os.getenv('NAME_CACHE_SIZE', '1024'))
+# seconds between full rebuilds of route_stats and flight_timeseries, 0 keeps only the incremental updates
+ROLLUPS_REFRESH_SECONDS = int(os.getenv('ROLLUPS_REFRESH_SECONDS', '0'))
+# seconds the analytics responses are cached for, 0 disables the cache
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '30'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '256'))
+# connection pool tuning, unset variables keep the driver defaults
+MONGODB_POOL_OPTIONS = {
+    option: int(os.environ[variable])
+    for variable, option in (
+        ('MONGODB_MAX_POOL_SIZE', 'maxPoolSize'),
+        ('MONGODB_MIN_POOL_SIZE', 'minPoolSize'),
+        ('MONGODB_MAX_CONNECTING', 'maxConnecting'),
+        ('MONGODB_MAX_IDLE_TIME_MS', 'maxIdleTimeMS'),
+        ('MONGODB_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+        ('MONGODB_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+        ('MONGODB_SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+        ('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+    )
+    if os.getenv(variable)
+}
+# opt-in request profiling, off unless PROFILING=1; then requests sent with an X-Profile header
+# and a PROFILE_SAMPLE_RATE fraction of the rest get a span breakdown (and a cProfile dump in PROFILE_DIR)
+PROFILING = os.getenv('PROFILING', '0') == '1'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR')
 
 app = FastAPI()
+app.metrics = Metrics()
+app.add_middleware(RouteTimingMiddleware, metrics=app.metrics)
+if PROFILING:
+    app.add_middleware(ProfilingMiddleware, sample_rate=PROFILE_SAMPLE_RATE, profile_dir=PROFILE_DIR)
 
 @app.on_event("startup")
-def startup_db_client():
-    app.mongodb_client = MongoClient(MONGODB_URI)
-    app.database = app.mongodb_client[DB_NAME]
-    print(f"Connected to MongoDB at: {MONGODB_URI} \n\t Database: {DB_NAME}")
+async def startup_db_client():
+    monitor = MongoMonitor(app.metrics)
+    if MONGODB_DRIVER == "motor":
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        app.mongodb_client = AsyncIOMotorClient(MONGODB_URI, event_listeners=[monitor], **MONGODB_POOL_OPTIONS)
+        app.database = app.mongodb_client[DB_NAME]
+    else:
+        app.mongodb_client = MongoClient(MONGODB_URI, event_listeners=[monitor], **MONGODB_POOL_OPTIONS)
+        app.database = ThreadedDatabase(app.mongodb_client[DB_NAME])
+    print(f"Connected to MongoDB at: {MONGODB_URI} ({MONGODB_DRIVER}) \n\t Database: {DB_NAME}")
+    app.index_manager = IndexManager(app.database)
+    app.index_manager.ensure_indexes_in_background()
+    app.name_cache = NameCache(app.database, NAME_CACHE_SIZE)
+    app.rollups = [RouteStats(app.database), FlightTimeSeries(app.database)]
+    for rollup in app.rollups:
+        rollup.rebuild_in_background(ROLLUPS_REFRESH_SECONDS)
+    app.response_cache = ResponseCache(LRUTTLBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS) if RESPONSE_CACHE_TTL_SECONDS > 0 else None)
 
 @app.on_event("shutdown")
 def shutdown_db_client():
@@ -27,3 +83,6 @@ def shutdown_db_client():
 app.include_router(airline_router, tags=["airlines"], prefix="/airline")
 app.include_router(city_router, tags=["cities"], prefix="/city")
 app.include_router(flight_router, tags=["flights"], prefix="/flight")
+app.include_router(index_router, tags=["indexes"], prefix="/index")
+app.include_router(cache_router, tags=["caches"], prefix="/cache")
+app.include_router(metrics_router, tags=["metrics"], prefix="/metrics")
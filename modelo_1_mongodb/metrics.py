@@ -0,0 +1,195 @@
+import threading
+import time
+
+from pymongo import monitoring
+
+from profiling import record_span
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative histogram with one series per label set, as Prometheus expects it."""
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # bucket counts, sum and count of the observations
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items(), key=lambda item: str(item[0])):
+                labels = dict(key)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(labels, le=bound)} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_labels(labels, le='+Inf')} {count}")
+                lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.command_duration = Histogram("mongodb_command_duration_seconds", "Duration of the MongoDB commands by collection and command")
+        self.command_failures = Counter("mongodb_command_failures_total", "Failed MongoDB commands by collection and command")
+        self.checkout_wait = Histogram("mongodb_pool_checkout_wait_seconds", "Time waited to check a connection out of the MongoDB pool")
+        self.checkout_failures = Counter("mongodb_pool_checkout_failures_total", "Failed connection checkouts by reason")
+        self.request_duration = Histogram("http_request_duration_seconds", "Duration of the API requests by route")
+
+    def render(self):
+        lines = []
+        for metric in (self.command_duration, self.command_failures, self.checkout_wait, self.checkout_failures, self.request_duration):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class MongoMonitor(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    """Driver listener recording command latencies and pool checkout waits into the metrics."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._collections = {}
+        self._checkouts = threading.local()
+        self._lock = threading.Lock()
+
+    # command monitoring
+    def started(self, event):
+        # most commands carry their collection name as the value of the command name key,
+        # getMore carries the cursor id there and the collection under its own key
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def _finished(self, event):
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), "")
+        return collection
+
+    def succeeded(self, event):
+        collection = self._finished(event)
+        record_span("db", event.duration_micros / 1e6, f"{collection}.{event.command_name}")
+        self.metrics.command_duration.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name)
+
+    def failed(self, event):
+        collection = self._finished(event)
+        record_span("db", event.duration_micros / 1e6, f"{collection}.{event.command_name} failed")
+        self.metrics.command_duration.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name)
+        self.metrics.command_failures.inc(collection=collection, command=event.command_name)
+
+    # connection pool monitoring, checkouts happen on the calling thread
+    def connection_check_out_started(self, event):
+        self._checkouts.started = time.perf_counter()
+
+    def _checkout_wait(self, event):
+        duration = getattr(event, "duration", None)
+        if duration is None:
+            duration = time.perf_counter() - getattr(self._checkouts, "started", time.perf_counter())
+        return duration
+
+    def connection_checked_out(self, event):
+        self.metrics.checkout_wait.observe(self._checkout_wait(event), address=f"{event.address[0]}:{event.address[1]}")
+
+    def connection_check_out_failed(self, event):
+        self.metrics.checkout_wait.observe(self._checkout_wait(event), address=f"{event.address[0]}:{event.address[1]}")
+        self.metrics.checkout_failures.inc(reason=event.reason)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+class RouteTimingMiddleware:
+    """ASGI middleware timing every request until its last byte is sent, by route template."""
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+        self._paths = None
+
+    def _route(self, scope):
+        if self._paths is None:
+            self._paths = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return self._paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.metrics.request_duration.observe(
+                time.perf_counter() - start, method=scope["method"], route=self._route(scope), status=status_code
+            )
@@ -163,3 +163,17 @@ class Flight_Popular_Airlines(BaseModel):
                 "count": 10
             }
         }
+
+class Flight_Timeseries(BaseModel):
+    year: int = Field(...)
+    month: int = Field(...)
+    count: int = Field(...)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "year": 2020,
+                "month": 1,
+                "count": 10
+            }
+        }
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+
+
+class NameCache:
+    """Size-bounded LRU cache of airline and city name to _id lookups."""
+
+    def __init__(self, database, maxsize=1024):
+        self.database = database
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def resolve(self, collection, name):
+        key = (collection, name)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # names that don't exist are not cached so a later insert is picked up
+        document = await self.database[collection].find_one({"name": name}, {"_id": 1})
+        if document is None:
+            return None
+
+        self.put(collection, name, document["_id"])
+        return document["_id"]
+
+    def put(self, collection, name, _id):
+        with self._lock:
+            self._entries[(collection, name)] = _id
+            self._entries.move_to_end((collection, name))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection, name=None):
+        with self._lock:
+            if name is not None:
+                self._entries.pop((collection, name), None)
+                return
+            for key in [key for key in self._entries if key[0] == collection]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,79 @@
+import base64
+import json
+
+from fastapi import HTTPException, status
+
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(_id):
+    return base64.urlsafe_b64encode(json.dumps(_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(after):
+    try:
+        return json.loads(base64.urlsafe_b64decode(after + "=" * (-len(after) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid cursor {after}")
+
+
+def page_cursor(collection, limit, skip=0, after=None, filter=None, projection=None):
+    """Cursor over a page of documents sorted by _id, starting after the _id encoded in the after cursor.
+
+    A filtered page is read from the index only when one has the filter's equality fields followed by _id.
+    """
+    filter = dict(filter or {})
+    if after is not None:
+        filter["_id"] = {"$gt": decode_cursor(after)}
+        # the cursor already marks where the page starts
+        skip = 0
+
+    return collection.find(filter, projection).sort("_id", 1).skip(skip).limit(limit)
+
+
+async def find_page(collection, response, limit, skip=0, after=None, filter=None, projection=None):
+    documents = await page_cursor(collection, limit, skip, after, filter, projection).to_list(length=None)
+
+    # a full page means there may be more documents after it
+    if limit > 0 and len(documents) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(documents[-1]["_id"])
+
+    return documents
+
+
+def plan_stages(plan):
+    # newer servers nest the classic plan under queryPlan
+    plan = plan.get("queryPlan", plan)
+    yield plan["stage"]
+    if "inputStage" in plan:
+        yield from plan_stages(plan["inputStage"])
+    for stage in plan.get("inputStages", []):
+        yield from plan_stages(stage)
+
+
+async def explain_page(collection, limit, skip=0, after=None, filter=None, projection=None):
+    """Winning plan of a page and whether the index bounds alone find its documents in _id order."""
+    explain = await page_cursor(collection, limit, skip, after, filter, projection).explain()
+    winning_plan = explain["queryPlanner"]["winningPlan"]
+    stages = list(plan_stages(winning_plan))
+    execution = explain.get("executionStats", {})
+    docs_examined = execution.get("totalDocsExamined")
+    returned = execution.get("nReturned")
+    # skipped documents are fetched before they are dropped, a cursor page skips none
+    skipped = 0 if after is not None else skip
+
+    # the _id_ index with the filter applied while fetching reads every document like a scan,
+    # and a SORT stage holds the whole match in memory before the first document is returned
+    return {
+        "filter": explain["queryPlanner"].get("parsedQuery", filter),
+        "stages": stages,
+        "collection_scan": "COLLSCAN" in stages,
+        "blocking_sort": "SORT" in stages,
+        "keys_examined": execution.get("totalKeysExamined"),
+        "docs_examined": docs_examined,
+        "returned": returned,
+        "index_backed": "COLLSCAN" not in stages and "SORT" not in stages
+            and docs_examined is not None and docs_examined <= returned + skipped,
+        "winning_plan": winning_plan
+    }
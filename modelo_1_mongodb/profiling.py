@@ -0,0 +1,136 @@
+import contextvars
+import cProfile
+import json
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+
+
+PROFILE_HEADER = "X-Profile"
+
+# the profile of the request being handled, copied into the driver threads with the context
+_current = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, kind, seconds, detail=None):
+        self.spans.append((kind, detail, seconds))
+
+    def breakdown(self, total=None):
+        """Seconds spent per span kind, whatever is left of the total is Python compute."""
+        total = time.perf_counter() - self.start if total is None else total
+        kinds = {}
+        for kind, _, seconds in self.spans:
+            kinds[kind] = kinds.get(kind, 0.0) + seconds
+        kinds["compute"] = max(total - sum(kinds.values()), 0.0)
+        kinds["total"] = total
+        return kinds
+
+    def server_timing(self):
+        calls = sum(1 for kind, _, _ in self.spans if kind == "db")
+        timings = []
+        for kind, seconds in self.breakdown().items():
+            description = f';desc="{calls} calls"' if kind == "db" else ""
+            timings.append(f"{kind};dur={seconds * 1000:.3f}{description}")
+        return ", ".join(timings)
+
+    def report(self):
+        return {
+            "method": self.method,
+            "path": self.path,
+            "breakdown_ms": {kind: round(seconds * 1000, 3) for kind, seconds in self.breakdown().items()},
+            "spans": [{"kind": kind, "detail": detail, "ms": round(seconds * 1000, 3)} for kind, detail, seconds in self.spans]
+        }
+
+
+def record_span(kind, seconds, detail=None):
+    profile = _current.get()
+    if profile is not None:
+        profile.add(kind, seconds, detail)
+
+
+@contextmanager
+def span(kind, detail=None):
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(kind, time.perf_counter() - start, detail)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling a sample of the requests, or those sent with the X-Profile header.
+
+    The span breakdown is printed once the response is sent, and returned in a Server-Timing header
+    when the response is sent in one body message; a streamed body is still being produced when its
+    headers go out, so its breakdown is only printed.
+    With profile_dir set, a cProfile stats file (readable by pstats, snakeviz or flameprof) is written
+    per profiled request, one request at a time. cProfile records the event loop thread from the start
+    to the end of that request: the file holds every other request the loop ran meanwhile and none of
+    the work done in the threadpool and driver threads, which the db spans time instead.
+    """
+
+    def __init__(self, app, sample_rate=0.0, profile_dir=None):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+        self._profiler_busy = False
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def _sampled(self, scope):
+        if any(name == PROFILE_HEADER.lower().encode() for name, _ in scope["headers"]):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._sampled(scope):
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = _current.set(profile)
+
+        profiler = None
+        if self.profile_dir and not self._profiler_busy:
+            self._profiler_busy = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start_message = None
+
+        async def send_with_timing(message):
+            nonlocal start_message
+            # hold the headers back until the first body message shows whether it is the whole body
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if start_message is not None:
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    start_message["headers"] = list(start_message.get("headers", [])) + [(b"server-timing", profile.server_timing().encode())]
+                await send(start_message)
+                start_message = None
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                self._profiler_busy = False
+                name = re.sub(r"[^A-Za-z0-9]+", "_", f"{profile.method}{profile.path}").strip("_")
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{int(time.time() * 1000)}-{name}.prof"))
+            print(f"Profile: {json.dumps(profile.report())}")
@@ -0,0 +1,90 @@
+import functools
+import time
+from collections import OrderedDict
+
+
+class LRUTTLBackend:
+    """In-process LRU storage whose entries expire ttl seconds after being set."""
+
+    def __init__(self, maxsize=256, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        expires_at, value = self._entries[key]
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCache:
+    """Caches route responses, any backend with get/set/clear can be plugged in (None disables caching)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        # bumped on every write so entries computed before it are never served again
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_compute(self, key, compute):
+        if self.backend is None:
+            return await compute()
+
+        key = (self.version, key)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = await compute()
+        self.backend.set(key, value)
+        return value
+
+    def invalidate(self):
+        self.version += 1
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": len(self.backend) if hasattr(self.backend, "__len__") else None,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+def cached_response(handler):
+    """Serve the handler response from request.app.response_cache, keyed on path and parameters."""
+
+    @functools.wraps(handler)
+    async def wrapper(**kwargs):
+        request = kwargs["request"]
+        params = tuple(sorted((name, value) for name, value in kwargs.items() if name not in ("request", "response")))
+        return await request.app.response_cache.get_or_compute(
+            (request.url.path, params), lambda: handler(**kwargs)
+        )
+
+    return wrapper
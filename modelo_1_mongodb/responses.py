@@ -0,0 +1,53 @@
+import json
+
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+
+from profiling import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def projection(model, fields=None):
+    """Mongo projection with the fields (by alias) of the model, or only the comma separated fields asked for."""
+    aliases = [field.alias for field in model.__fields__.values()]
+    if fields is None:
+        return {alias: 1 for alias in aliases}
+
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in aliases]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields {', '.join(unknown)}, use any of {', '.join(aliases)}")
+    return {"_id": 1, **{field: 1 for field in requested}}
+
+
+class FastJSONResponse(JSONResponse):
+    """Encodes Mongo documents as they are, with orjson when it is installed."""
+
+    def render(self, content):
+        return dumps(content)
+
+
+def fast_response(content, response=None):
+    """Skip the response_model validation, the route keeps its response_model for the OpenAPI schema."""
+    headers = None
+    if response is not None:
+        headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+    with span("serialization"):
+        return FastJSONResponse(content, headers=headers)
+
+
+async def created_response(collection, document, result, verify=False):
+    """The encoded document is what was written, it is read back from the collection only when asked to."""
+    if not verify:
+        return document
+    return await collection.find_one({"_id": result.inserted_id})
@@ -0,0 +1,182 @@
+import asyncio
+from abc import ABC, abstractmethod
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+ROUTE_STATS_COLLECTION = "route_stats"
+TIMESERIES_COLLECTION = "flight_timeseries"
+# seconds before a failed rebuild of a stale rollup is tried again
+STALE_RETRY_SECONDS = 60
+
+
+class Rollup(ABC):
+    """Collection of flight aggregates kept up to date on every insert and rebuilt with $merge.
+
+    A rebuild replaces the groups it counted, so an insert recorded while it runs is either lost or
+    counted twice. Flight inserts wait for the startup build, and for the rebuild of a rollup left stale
+    by a failed update, through built; the periodic rebuilds do not block them, a group drifting then is
+    corrected by the next rebuild.
+    """
+
+    collection = None
+    # recount every group from the flights collection into the rollup collection
+    rebuild_pipeline = None
+
+    def __init__(self, database):
+        self.database = database
+        # set once the startup build is done, flights are inserted only after it
+        self.built = asyncio.Event()
+        # set when an update failed, the rollup misses flights until it is rebuilt
+        self.stale = asyncio.Event()
+        self._task = None
+
+    @abstractmethod
+    def updates(self, flights):
+        """Upserts adding the flights to their groups."""
+
+    async def record(self, flights):
+        """Count inserted flights, a failure marks the rollup stale instead of failing the stored insert."""
+        updates = self.updates(flights)
+        if not updates:
+            return
+        try:
+            try:
+                await self.database[self.collection].bulk_write(updates, ordered=False)
+            except BulkWriteError as e:
+                # concurrent upserts creating the same _id race on its index, the losers are retried as updates
+                errors = e.details["writeErrors"]
+                if any(error["code"] != 11000 for error in errors):
+                    raise
+                await self.database[self.collection].bulk_write([updates[error["index"]] for error in errors], ordered=False)
+        except PyMongoError as e:
+            print(f"Failed to update {self.collection}, rebuilding it: {e}")
+            self.stale.set()
+
+    async def rebuild(self):
+        await self.database["flights"].aggregate(self.rebuild_pipeline).to_list(length=None)
+
+    async def ensure_built(self):
+        # build the rollup for flights loaded before it existed
+        if await self.database[self.collection].estimated_document_count() == 0 \
+                and await self.database["flights"].estimated_document_count() > 0:
+            await self.rebuild()
+
+    async def _rebuild_every(self, seconds):
+        try:
+            await self.ensure_built()
+        except PyMongoError as e:
+            print(f"Failed to build {self.collection}: {e}")
+        finally:
+            self.built.set()
+
+        while True:
+            # rebuild every refresh interval, and as soon as an update failed
+            try:
+                await asyncio.wait_for(self.stale.wait(), seconds if seconds > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+            stale = self.stale.is_set()
+            self.stale.clear()
+            if stale:
+                self.built.clear()
+            try:
+                await self.rebuild()
+                failed = False
+            except PyMongoError as e:
+                print(f"Failed to rebuild {self.collection}: {e}")
+                failed = True
+            self.built.set()
+            if failed and stale:
+                await asyncio.sleep(STALE_RETRY_SECONDS)
+                self.stale.set()
+
+    def rebuild_in_background(self, seconds=0):
+        self._task = asyncio.get_running_loop().create_task(self._rebuild_every(seconds))
+        return self._task
+
+
+class RouteStats(Rollup):
+    """Per route (from_city_id, to_city_id) flight counts and duration sums."""
+
+    collection = ROUTE_STATS_COLLECTION
+    rebuild_pipeline = [
+        {
+            "$group": {
+                "_id": {"from_city_id": "$from_city_id", "to_city_id": "$to_city_id"},
+                "count": {"$sum": 1},
+                "duration_sum": {"$sum": "$duration"},
+                "duration_count": {"$sum": 1}
+            }
+        },
+        {
+            "$merge": {
+                "into": ROUTE_STATS_COLLECTION,
+                "on": "_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }
+        }
+    ]
+
+    def updates(self, flights):
+        # one $inc per route touched by the inserted flights
+        routes = {}
+        for flight in flights:
+            key = (flight["from_city_id"], flight["to_city_id"])
+            count, duration_sum = routes.get(key, (0, 0))
+            routes[key] = (count + 1, duration_sum + flight["duration"])
+
+        return [
+            UpdateOne(
+                {"_id": {"from_city_id": from_city_id, "to_city_id": to_city_id}},
+                {"$inc": {"count": count, "duration_sum": duration_sum, "duration_count": count}},
+                upsert=True
+            )
+            for (from_city_id, to_city_id), (count, duration_sum) in routes.items()
+        ]
+
+
+class FlightTimeSeries(Rollup):
+    """Flight counts per route, airline, year and month."""
+
+    collection = TIMESERIES_COLLECTION
+    rebuild_pipeline = [
+        {
+            "$group": {
+                "_id": {
+                    "from_city_id": "$from_city_id",
+                    "to_city_id": "$to_city_id",
+                    "airline_id": "$airline_id",
+                    "year": "$year",
+                    "month": "$month"
+                },
+                "count": {"$sum": 1}
+            }
+        },
+        {
+            "$merge": {
+                "into": TIMESERIES_COLLECTION,
+                "on": "_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }
+        }
+    ]
+
+    def updates(self, flights):
+        # one $inc per (route, airline, year, month) touched by the inserted flights
+        buckets = {}
+        for flight in flights:
+            key = (flight["from_city_id"], flight["to_city_id"], flight["airline_id"], flight["year"], flight["month"])
+            buckets[key] = buckets.get(key, 0) + 1
+
+        return [
+            UpdateOne(
+                {"_id": {"from_city_id": from_city_id, "to_city_id": to_city_id, "airline_id": airline_id, "year": year, "month": month}},
+                {"$inc": {"count": count}},
+                upsert=True
+            )
+            for (from_city_id, to_city_id, airline_id, year, month), count in buckets.items()
+        ]
@@ -1,72 +1,128 @@
 from fastapi import APIRouter, Body, Request, Response, HTTPException, status
 from fastapi.encoders import jsonable_encoder
-from typing import List
+from pymongo.errors import DuplicateKeyError
+from typing import List, Optional
 
 from model import Airline
+from pagination import find_page
+from response_cache import cached_response
+from responses import created_response, fast_response, projection
 
 router = APIRouter()
 
 @router.post("/", response_description="Post a new airline", status_code=status.HTTP_201_CREATED, response_model=Airline)
-def create_airline(request: Request, airline: Airline = Body(...)):
+async def create_airline(request: Request, airline: Airline = Body(...), verify: bool = False):
     airline = jsonable_encoder(airline)
-    new_airline = request.app.database["airlines"].insert_one(airline)
-    created_airline = request.app.database["airlines"].find_one(
-        {"_id": new_airline.inserted_id}
-    )
+    try:
+        new_airline = await request.app.database["airlines"].insert_one(airline)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Airline {airline['name']} already exists")
+    request.app.name_cache.invalidate("airlines", airline["name"])
+    request.app.response_cache.invalidate()
 
-    return created_airline
+    return await created_response(request.app.database["airlines"], airline, new_airline, verify)
 
 
 @router.get("/", response_description="Get all airlines", response_model=List[Airline])
-def list_airlines(request: Request, limit: int = 20, skip: int = 0):
-    airlines = list(request.app.database["airlines"].find().skip(skip).limit(limit))
-    return airlines
+async def list_airlines(request: Request, response: Response, limit: int = 20, skip: int = 0, after: Optional[str] = None):
+    airlines = await find_page(request.app.database["airlines"], response, limit, skip, after, projection=projection(Airline))
+    return fast_response(airlines, response)
 
 
 @router.get("/{id}", response_description="Get stats for a single airline by id")
-def airline_stats(id: str, request: Request):
-    airline = request.app.database["airlines"].find_one({"_id": id})
-    flights = list(request.app.database["flights"].find({"airline_id": id}))
-
-    # calculate the number of flights for that airline
-    num_flights = len(flights)
-
-    # get the most popular destination (from_city_id, to_city_id) for that airline
-    most_popular_destination = max(
-        [(flight["from_city_id"], flight["to_city_id"]) for flight in flights],
-        key=lambda x: (x[0], x[1])
-    )
-  
-    # get the destination city name from the city id (from_city, to_city)
-    from_city = request.app.database["cities"].find_one({"_id": most_popular_destination[0]})
-    to_city = request.app.database["cities"].find_one({"_id": most_popular_destination[1]})
-
-    # calculate the best month to travel in that airline
-    months = {}
-    for flight in flights:
-        if flight["month"] in months:
-            months[flight["month"]] += 1
-        else:
-            months[flight["month"]] = 1
-    best_month = max(months, key=months.get)
+@cached_response
+async def airline_stats(id: str, request: Request):
+    airline = await request.app.database["airlines"].find_one({"_id": id})
+    if airline is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Airline with ID {id} not found")
+
+    # compute every stat server side in a single pass over the airline flights
+    pipeline = [
+        {
+            "$match": {"airline_id": id}
+        },
+        {
+            "$facet": {
+                # number of flights and average age of the passengers for that airline
+                "summary": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "num_flights": {"$sum": 1},
+                            "avg_age": {"$avg": "$age"}
+                        }
+                    }
+                ],
+                # most popular destination (from_city_id, to_city_id) with its city names
+                "most_popular_destination": [
+                    {
+                        "$group": {
+                            "_id": {"from_city_id": "$from_city_id", "to_city_id": "$to_city_id"},
+                            "passengers": {"$sum": 1}
+                        }
+                    },
+                    {
+                        "$sort": {"passengers": -1, "_id": 1}
+                    },
+                    {
+                        "$limit": 1
+                    },
+                    {
+                        "$lookup": {
+                            "from": "cities",
+                            "localField": "_id.from_city_id",
+                            "foreignField": "_id",
+                            "as": "from_city"
+                        }
+                    },
+                    {
+                        "$lookup": {
+                            "from": "cities",
+                            "localField": "_id.to_city_id",
+                            "foreignField": "_id",
+                            "as": "to_city"
+                        }
+                    }
+                ],
+                # best month to travel in that airline
+                "best_month": [
+                    {
+                        "$group": {
+                            "_id": "$month",
+                            "count": {"$sum": 1}
+                        }
+                    },
+                    {
+                        "$sort": {"count": -1, "_id": 1}
+                    },
+                    {
+                        "$limit": 1
+                    }
+                ]
+            }
+        }
+    ]
+    stats = (await request.app.database["flights"].aggregate(pipeline).to_list(length=1))[0]
 
     # convert the month number to month name
     months = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 
-    best_month = months[best_month - 1]
-
-    # calculate the average age of the passengers for that airline
-    ages = [passenger["age"] for passenger in flights]
-    avg_age = sum(ages) / len(ages)
-
-    # calculate the number of passengers for most popular destination for that airline
-    passengers = [flight["age"] for flight in flights if flight["from_city_id"] == most_popular_destination[0] and flight["to_city_id"] == most_popular_destination[1]]
+    summary = stats["summary"][0] if stats["summary"] else {"num_flights": 0, "avg_age": None}
+    most_popular_destination = None
+    passengers = 0
+    if stats["most_popular_destination"]:
+        destination = stats["most_popular_destination"][0]
+        from_city = destination["from_city"][0]["name"] if destination["from_city"] else destination["_id"]["from_city_id"]
+        to_city = destination["to_city"][0]["name"] if destination["to_city"] else destination["_id"]["to_city_id"]
+        most_popular_destination = f"{from_city} to {to_city}"
+        passengers = destination["passengers"]
+    best_month = months[stats["best_month"][0]["_id"] - 1] if stats["best_month"] else None
 
     return {
         "airline": airline["name"],
-        f"num_flights in {airline['name']}": num_flights,
-        "most_popular_destination": f"{from_city['name']} to {to_city['name']}",
+        f"num_flights in {airline['name']}": summary["num_flights"],
+        "most_popular_destination": most_popular_destination,
         f"best_month to travel in {airline['name']}": best_month,
-        f"avg_age of passengers in {airline['name']}": avg_age,
-        f"passengers_for_most_popular_destination in {airline['name']}": len(passengers)
-    }
\ No newline at end of file
+        f"avg_age of passengers in {airline['name']}": summary["avg_age"],
+        f"passengers_for_most_popular_destination in {airline['name']}": passengers
+    }
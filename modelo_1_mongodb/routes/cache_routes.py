@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Request
+
+router = APIRouter()
+
+@router.get("/names", response_description="Get hit/miss counters of the airline and city name cache")
+def name_cache_stats(request: Request):
+    return request.app.name_cache.stats()
+
+
+@router.get("/responses", response_description="Get hit/miss counters of the analytics response cache")
+def response_cache_stats(request: Request):
+    return request.app.response_cache.stats()
@@ -1,80 +1,143 @@
 from fastapi import APIRouter, Body, Request, Response, HTTPException, status
 from fastapi.encoders import jsonable_encoder
-from typing import List
+from pymongo.errors import DuplicateKeyError
+from typing import List, Optional
 
 from model import City
+from pagination import find_page
+from response_cache import cached_response
+from responses import created_response, fast_response, projection
 
 router = APIRouter()
 
 @router.post("/", response_description="Post a new city", status_code=status.HTTP_201_CREATED, response_model=City)
-def create_city(request: Request, city: City = Body(...)):
+async def create_city(request: Request, city: City = Body(...), verify: bool = False):
     city = jsonable_encoder(city)
-    new_city = request.app.database["cities"].insert_one(city)
-    created_city = request.app.database["cities"].find_one(
-        {"_id": new_city.inserted_id}
-    )
+    try:
+        new_city = await request.app.database["cities"].insert_one(city)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"City {city['name']} already exists")
+    request.app.name_cache.invalidate("cities", city["name"])
+    request.app.response_cache.invalidate()
 
-    return created_city
+    return await created_response(request.app.database["cities"], city, new_city, verify)
 
 
 @router.get("/", response_description="Get all cities", response_model=List[City])
-def list_cities(request: Request, limit: int = 20, skip: int = 0):
-    cities = list(request.app.database["cities"].find().skip(skip).limit(limit))
-    return cities
+async def list_cities(request: Request, response: Response, limit: int = 20, skip: int = 0, after: Optional[str] = None):
+    cities = await find_page(request.app.database["cities"], response, limit, skip, after, projection=projection(City))
+    return fast_response(cities, response)
 
 
 @router.get("/{id}", response_description="Get stats for a single city by id")
-def find_city(id: str, request: Request):
-    city = request.app.database["cities"].find_one({"_id": id })
-    flights = list(request.app.database["flights"].find({"from_city_id": id}))
-
-    # calculate the number of flights for that city
-    num_flights = len(flights)
-
-    # get the most popular to_city_id for the city id we received as a parameter where the city is the from_city_id
-    most_popular_destination = max(
-        [(flight["to_city_id"]) for flight in flights],
-        key=lambda x: (x)
-    )
-
-    # get the destination city name from the city id (from_city, to_city)
-    to_city = request.app.database["cities"].find_one({"_id": most_popular_destination})
-
-    # calculate the best month to travel from that city
-    months = {}
-    for flight in flights:
-        if flight["month"] in months:
-            months[flight["month"]] += 1
-        else:
-            months[flight["month"]] = 1
-    best_month = max(months, key=months.get)
+@cached_response
+async def find_city(id: str, request: Request):
+    city = await request.app.database["cities"].find_one({"_id": id })
+    if city is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"City with ID {id} not found")
+
+    # compute every stat server side in a single pass over the flights departing from that city
+    pipeline = [
+        {
+            "$match": {"from_city_id": id}
+        },
+        {
+            "$facet": {
+                # number of flights and average duration of the flights from that city
+                "summary": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "num_flights": {"$sum": 1},
+                            "avg_duration": {"$avg": "$duration"}
+                        }
+                    }
+                ],
+                # most popular to_city_id for the city id we received as a parameter
+                "most_popular_destination": [
+                    {
+                        "$group": {
+                            "_id": "$to_city_id",
+                            "count": {"$sum": 1}
+                        }
+                    },
+                    {
+                        "$sort": {"count": -1, "_id": 1}
+                    },
+                    {
+                        "$limit": 1
+                    },
+                    {
+                        "$lookup": {
+                            "from": "cities",
+                            "localField": "_id",
+                            "foreignField": "_id",
+                            "as": "to_city"
+                        }
+                    }
+                ],
+                # best month to travel from that city
+                "best_month": [
+                    {
+                        "$group": {
+                            "_id": "$month",
+                            "count": {"$sum": 1}
+                        }
+                    },
+                    {
+                        "$sort": {"count": -1, "_id": 1}
+                    },
+                    {
+                        "$limit": 1
+                    }
+                ],
+                # what airline has the most flights from that city
+                "most_flights_airline": [
+                    {
+                        "$group": {
+                            "_id": "$airline_id",
+                            "count": {"$sum": 1}
+                        }
+                    },
+                    {
+                        "$sort": {"count": -1, "_id": 1}
+                    },
+                    {
+                        "$limit": 1
+                    },
+                    {
+                        "$lookup": {
+                            "from": "airlines",
+                            "localField": "_id",
+                            "foreignField": "_id",
+                            "as": "airline"
+                        }
+                    }
+                ]
+            }
+        }
+    ]
+    stats = (await request.app.database["flights"].aggregate(pipeline).to_list(length=1))[0]
 
     # convert the month number to month name
     months = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 
-    best_month = months[best_month - 1]
-
-    # calculate the average duration of the flights from that city
-    durations = [flight["duration"] for flight in flights]
-    avg_duration = sum(durations) / len(durations)
-
-    # what airline has the most flights from/to that city
-    airlines = {}
-    for flight in flights:
-        if flight["airline_id"] in airlines:
-            airlines[flight["airline_id"]] += 1
-        else:
-            airlines[flight["airline_id"]] = 1
-    most_flights_airline = max(airlines, key=airlines.get)
-
-    # get the airline name from the airline id
-    airline = request.app.database["airlines"].find_one({"_id": most_flights_airline})
+    summary = stats["summary"][0] if stats["summary"] else {"num_flights": 0, "avg_duration": None}
+    to_city = None
+    if stats["most_popular_destination"]:
+        destination = stats["most_popular_destination"][0]
+        to_city = destination["to_city"][0]["name"] if destination["to_city"] else destination["_id"]
+    best_month = months[stats["best_month"][0]["_id"] - 1] if stats["best_month"] else None
+    airline = None
+    if stats["most_flights_airline"]:
+        most_flights_airline = stats["most_flights_airline"][0]
+        airline = most_flights_airline["airline"][0]["name"] if most_flights_airline["airline"] else most_flights_airline["_id"]
 
     return {
         "city": city["name"],
-        f"num_flights from {city['name']}": num_flights,
-        f"most_popular_destination (to_city) for {city['name']}": to_city["name"],
+        f"num_flights from {city['name']}": summary["num_flights"],
+        f"most_popular_destination (to_city) for {city['name']}": to_city,
         f"best_month to travel from {city['name']}": best_month,
-        f"avg_duration from {city['name']}": avg_duration,
-        f"most_flights_airline from {city['name']}": airline["name"]
+        f"avg_duration from {city['name']}": summary["avg_duration"],
+        f"most_flights_airline from {city['name']}": airline
     }
@@ -1,172 +1,401 @@
 #!/usr/bin/env python3
-from fastapi import APIRouter, Body, Request, Response, HTTPException, status
+import csv
+import io
+import json
+
+from fastapi import APIRouter, Body, Query, Request, Response, HTTPException, status
 from fastapi.encoders import jsonable_encoder
-from typing import List
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import List, Optional
 
-from model import Flight_Insert, Flight_Search, Flight_Common_Destinations, Flight_Average_Duration, Flight_Popular_Airlines
+from aggregations import group_then_resolve
+from model import Flight_Insert, Flight_Search, Flight_Common_Destinations, Flight_Average_Duration, Flight_Popular_Airlines, Flight_Timeseries
+from pagination import explain_page, find_page
+from response_cache import cached_response
+from responses import created_response, dumps, fast_response, projection
+from rollups import ROUTE_STATS_COLLECTION, TIMESERIES_COLLECTION
 
 router = APIRouter()
 
+NDJSON_CONTENT_TYPES = ["application/x-ndjson", "application/ndjson", "application/jsonl"]
+# same header as data/flight_passengers.csv
+FLIGHT_CSV_FIELDS = ["airline", "from", "to", "day", "month", "year", "duration", "age", "gender", "reason", "stay", "transit", "connection", "wait", "ticket", "checked_bags", "carry_on"]
+MAX_EXPORT_BATCH_SIZE = 10000
+
 @router.post("/", response_description="Post a new flight", status_code=status.HTTP_201_CREATED, response_model=Flight_Search)
-def create_flight(request: Request, flight: Flight_Insert = Body(...)):
+async def create_flight(request: Request, flight: Flight_Insert = Body(...), verify: bool = False):
     flight = jsonable_encoder(flight)
 
-    flight["airline_id"] = request.app.database["airlines"].find_one({"name": flight["airline"]})["_id"]
-    flight["from_city_id"] = request.app.database["cities"].find_one({"name": flight["from_city"]})["_id"]
-    flight["to_city_id"] = request.app.database["cities"].find_one({"name": flight["to"]})["_id"]
+    flight["airline_id"] = await request.app.name_cache.resolve("airlines", flight["airline"])
+    flight["from_city_id"] = await request.app.name_cache.resolve("cities", flight["from_city"])
+    flight["to_city_id"] = await request.app.name_cache.resolve("cities", flight["to"])
+
+    if flight["airline_id"] is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Airline {flight['airline']} not found")
+    for field, name in (("from_city_id", flight["from_city"]), ("to_city_id", flight["to"])):
+        if flight[field] is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"City {name} not found")
 
     # drop unused fields
     del flight["airline"]
     del flight["from_city"]
     del flight["to"]
 
-    new_flight = request.app.database["flights"].insert_one(flight)
-    created_flight = request.app.database["flights"].find_one(
-        {"_id": new_flight.inserted_id}
-    )
+    for rollup in request.app.rollups:
+        await rollup.built.wait()
+    try:
+        new_flight = await request.app.database["flights"].insert_one(flight)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Flight {flight['_id']} already exists")
+    for rollup in request.app.rollups:
+        await rollup.record([flight])
+    request.app.response_cache.invalidate()
 
-    return created_flight
+    return await created_response(request.app.database["flights"], flight, new_flight, verify)
 
 
-@router.get("/", response_description="Get all flights", response_model=List[Flight_Search])
-def list_flights(request: Request, limit: int = 20, skip: int = 0):
-    flights = list(request.app.database["flights"].find().skip(skip).limit(limit))
-    return flights
+async def _read_flights(request):
+    # NDJSON bodies are consumed line by line as they arrive, JSON arrays are parsed at once
+    if request.headers.get("content-type", "").split(";")[0].strip() in NDJSON_CONTENT_TYPES:
+        position = 0
+        buffer = b""
+        async for data in request.stream():
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield position, line
+                    position += 1
+        if buffer.strip():
+            yield position, buffer
+        return
 
+    try:
+        rows = json.loads(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Invalid JSON body: {e}")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Expected a JSON array of flights")
+    for position, row in enumerate(rows):
+        yield position, row
 
-@router.get("/{id}", response_description="Get a single flight by id", response_model=Flight_Search)
-def find_flight(id: str, request: Request):
-    if (flight := request.app.database["flights"].find_one({"_id": id})) is not None:
-        return flight
-    
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Flight with ID {id} not found")
 
+async def _insert_flights(request, rows, ordered):
+    errors = []
+
+    # resolve every distinct airline and city name of the chunk only once
+    names = {("airlines", flight["airline"]) for _, flight in rows}
+    names |= {("cities", flight["from_city"]) for _, flight in rows}
+    names |= {("cities", flight["to"]) for _, flight in rows}
+    ids = {(collection, name): await request.app.name_cache.resolve(collection, name) for collection, name in names}
+
+    documents = []
+    positions = []
+    for position, flight in rows:
+        if ids[("airlines", flight["airline"])] is None:
+            errors.append({"index": position, "error": f"Airline {flight['airline']} not found"})
+        elif ids[("cities", flight["from_city"])] is None:
+            errors.append({"index": position, "error": f"City {flight['from_city']} not found"})
+        elif ids[("cities", flight["to"])] is None:
+            errors.append({"index": position, "error": f"City {flight['to']} not found"})
+        else:
+            flight["airline_id"] = ids[("airlines", flight.pop("airline"))]
+            flight["from_city_id"] = ids[("cities", flight.pop("from_city"))]
+            flight["to_city_id"] = ids[("cities", flight.pop("to"))]
+            documents.append(flight)
+            positions.append(position)
+            continue
+
+        # ordered inserts stop at the first failing row
+        if ordered:
+            break
+
+    inserted = []
+    if documents:
+        for rollup in request.app.rollups:
+            await rollup.built.wait()
+        try:
+            await request.app.database["flights"].insert_many(documents, ordered=ordered)
+            inserted = documents
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details["writeErrors"]}
+            # ordered inserts stop at the first error, unordered ones skip only the failing rows
+            inserted = documents[:min(failed)] if ordered else [document for index, document in enumerate(documents) if index not in failed]
+            for error in e.details["writeErrors"]:
+                errors.append({"index": positions[error["index"]], "error": error["errmsg"]})
+        for rollup in request.app.rollups:
+            await rollup.record(inserted)
+        if inserted:
+            request.app.response_cache.invalidate()
+
+    return len(inserted), errors
+
+
+@router.post("/bulk", response_description="Post many flights as a JSON array or NDJSON stream", status_code=status.HTTP_201_CREATED)
+async def create_flights_bulk(request: Request, ordered: bool = False, chunk_size: int = Query(1000, ge=1, le=10000)):
+    inserted = 0
+    errors = []
+    chunk = []
+
+    async for position, row in _read_flights(request):
+        try:
+            if isinstance(row, bytes):
+                row = json.loads(row)
+            chunk.append((position, jsonable_encoder(Flight_Insert.parse_obj(row))))
+        except ValidationError as e:
+            errors.append({"index": position, "error": e.errors()})
+            if ordered:
+                break
+        except ValueError as e:
+            errors.append({"index": position, "error": f"Invalid JSON: {e}"})
+            if ordered:
+                break
+
+        if len(chunk) >= chunk_size:
+            chunk_inserted, chunk_errors = await _insert_flights(request, chunk, ordered)
+            inserted += chunk_inserted
+            errors += chunk_errors
+            chunk = []
+            if ordered and chunk_errors:
+                break
+
+    if chunk:
+        chunk_inserted, chunk_errors = await _insert_flights(request, chunk, ordered)
+        inserted += chunk_inserted
+        errors += chunk_errors
+
+    # validation errors are found while reading, insert errors once their chunk is written
+    errors.sort(key=lambda error: error["index"])
+    # an ordered insert stops at its first failing row, the invalid row that ended the reading may come after it
+    if ordered:
+        errors = errors[:1]
+
+    return {
+        "inserted": inserted,
+        "errors": errors
+    }
+
+
+async def _flight_filter(request, from_city, to_city, airline, year_from, year_to, month_from, month_to, ticket, connection):
+    # names are resolved to the ids stored in the flights so the filter can use their indexes,
+    # an unknown name resolves to None which no flight matches
+    filter = {}
+    if from_city is not None:
+        filter["from_city_id"] = await request.app.name_cache.resolve("cities", from_city)
+    if to_city is not None:
+        filter["to_city_id"] = await request.app.name_cache.resolve("cities", to_city)
+    if airline is not None:
+        filter["airline_id"] = await request.app.name_cache.resolve("airlines", airline)
+
+    for field, lower, upper in (("year", year_from, year_to), ("month", month_from, month_to)):
+        if lower is not None and lower == upper:
+            filter[field] = lower
+        elif lower is not None or upper is not None:
+            filter[field] = {}
+            if lower is not None:
+                filter[field]["$gte"] = lower
+            if upper is not None:
+                filter[field]["$lte"] = upper
+
+    if ticket is not None:
+        filter["ticket"] = ticket
+    if connection is not None:
+        filter["connection"] = connection
+
+    return filter
+
+
+@router.get("/", response_description="Get all flights, optionally filtered by route, airline, date range, ticket and connection", response_model=List[Flight_Search])
+async def list_flights(
+    request: Request,
+    response: Response,
+    limit: int = 20,
+    skip: int = 0,
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    from_city: Optional[str] = None,
+    to_city: Optional[str] = None,
+    airline: Optional[str] = None,
+    year_from: Optional[int] = None,
+    year_to: Optional[int] = None,
+    month_from: Optional[int] = None,
+    month_to: Optional[int] = None,
+    ticket: Optional[str] = None,
+    connection: Optional[bool] = None,
+    explain: bool = False
+):
+    filter = await _flight_filter(request, from_city, to_city, airline, year_from, year_to, month_from, month_to, ticket, connection)
+
+    # report the winning plan instead of the flights, to confirm the filter uses an index
+    if explain:
+        return fast_response(await explain_page(request.app.database["flights"], limit, skip, after, filter, projection(Flight_Search, fields)))
+
+    flights = await find_page(request.app.database["flights"], response, limit, skip, after, filter, projection(Flight_Search, fields))
+    return fast_response(flights, response)
+
+
+async def _export_ndjson(cursor, batch_size):
+    lines = []
+    async for flight in cursor:
+        lines.append(dumps(flight))
+        if len(lines) >= batch_size:
+            yield b"\n".join(lines) + b"\n"
+            lines = []
+    if lines:
+        yield b"\n".join(lines) + b"\n"
+
+
+async def _export_csv(cursor, batch_size, names):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FLIGHT_CSV_FIELDS)
+    rows = 0
+    async for flight in cursor:
+        flight["airline"] = names.get(flight["airline_id"], flight["airline_id"])
+        flight["from"] = names.get(flight["from_city_id"], flight["from_city_id"])
+        flight["to"] = names.get(flight["to_city_id"], flight["to_city_id"])
+        writer.writerow([flight.get(field, "") for field in FLIGHT_CSV_FIELDS])
+        rows += 1
+        if rows % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@router.get("/export", response_description="Stream all flights as NDJSON or CSV")
+async def export_flights(request: Request, format: str = "ndjson", batch_size: int = 1000):
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported export format {format}, use ndjson or csv")
+    batch_size = max(1, min(batch_size, MAX_EXPORT_BATCH_SIZE))
+
+    cursor = request.app.database["flights"].find({}, projection(Flight_Search)).batch_size(batch_size)
+
+    if format == "csv":
+        # the airline and city catalogs are tiny, resolve their names once for the whole export
+        names = {}
+        for collection in ("airlines", "cities"):
+            async for document in request.app.database[collection].find():
+                names[document["_id"]] = document["name"]
+        return StreamingResponse(_export_csv(cursor, batch_size, names), media_type="text/csv")
+
+    return StreamingResponse(_export_ndjson(cursor, batch_size), media_type="application/x-ndjson")
+
+
+@router.get("/timeseries", response_description="Get the number of flights per year and month", response_model=List[Flight_Timeseries])
+@cached_response
+async def timeseries(
+    request: Request,
+    from_city: Optional[str] = None,
+    to_city: Optional[str] = None,
+    city: Optional[str] = None,
+    airline: Optional[str] = None,
+    year_from: Optional[int] = None,
+    year_to: Optional[int] = None
+):
+    # served from the flight_timeseries rollup, already counted per route, airline, year and month
+    match = {}
+    if from_city is not None:
+        match["_id.from_city_id"] = await request.app.name_cache.resolve("cities", from_city)
+    if to_city is not None:
+        match["_id.to_city_id"] = await request.app.name_cache.resolve("cities", to_city)
+    if city is not None:
+        city_id = await request.app.name_cache.resolve("cities", city)
+        match["$or"] = [{"_id.from_city_id": city_id}, {"_id.to_city_id": city_id}]
+    if airline is not None:
+        match["_id.airline_id"] = await request.app.name_cache.resolve("airlines", airline)
+    if year_from is not None or year_to is not None:
+        match["_id.year"] = {}
+        if year_from is not None:
+            match["_id.year"]["$gte"] = year_from
+        if year_to is not None:
+            match["_id.year"]["$lte"] = year_to
 
-@router.get("/common_destinations/", response_description="Get common destinations", response_model=List[Flight_Common_Destinations])
-def common_destinations(request: Request, limit: int = 5, skip: int = 0):
     pipeline = [
         {
-            "$lookup": {
-                "from": "cities",
-                "localField": "from_city_id",
-                "foreignField": "_id",
-                "as": "from_city"
-            }
-        },
-        {
-            "$unwind": "$from_city"
-        },
-        {
-            "$lookup": {
-                "from": "cities",
-                "localField": "to_city_id",
-                "foreignField": "_id",
-                "as": "to_city"
-            }
-        },
-        {
-            "$unwind": "$to_city"
+            "$match": match
         },
         {
             "$group": {
-                "_id": {"from_city": "$from_city.name", "to_city": "$to_city.name"},
-                "count": {"$sum": 1}
+                "_id": {"year": "$_id.year", "month": "$_id.month"},
+                "count": {"$sum": "$count"}
             }
         },
         {
-            "$sort": {"count": -1}
-        },
-        {
-            "$skip": skip
+            "$sort": {"_id.year": 1, "_id.month": 1}
         },
         {
-            "$limit": limit
+            "$project": {
+                "_id": 0,
+                "year": "$_id.year",
+                "month": "$_id.month",
+                "count": 1
+            }
         }
     ]
-    flights = list(request.app.database["flights"].aggregate(pipeline))
+    series = await request.app.database[TIMESERIES_COLLECTION].aggregate(pipeline).to_list(length=None)
+
+    return series
+
+
+@router.get("/{id}", response_description="Get a single flight by id", response_model=Flight_Search)
+async def find_flight(id: str, request: Request, fields: Optional[str] = None):
+    if (flight := await request.app.database["flights"].find_one({"_id": id}, projection(Flight_Search, fields))) is not None:
+        return fast_response(flight)
+    
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Flight with ID {id} not found")
+
+
+@router.get("/common_destinations/", response_description="Get common destinations", response_model=List[Flight_Common_Destinations])
+@cached_response
+async def common_destinations(request: Request, limit: int = 5, skip: int = 0):
+    # route_stats is already grouped by route, only the returned routes are joined with their city names
+    pipeline = group_then_resolve(
+        id={"from_city": "$from_city", "to_city": "$to_city"},
+        fields=["count"],
+        sort={"count": -1, "_id": 1},
+        skip=skip,
+        limit=limit,
+        resolve={"from_city": ("_id.from_city_id", "cities"), "to_city": ("_id.to_city_id", "cities")}
+    )
+    flights = await request.app.database[ROUTE_STATS_COLLECTION].aggregate(pipeline).to_list(length=None)
 
     return flights
 
 
 @router.get("/average_duration/", response_description="Get average duration", response_model=List[Flight_Average_Duration])
-def average_duration(request: Request, limit: int = 10, skip: int = 0):
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "cities",
-                "localField": "from_city_id",
-                "foreignField": "_id",
-                "as": "from_city"
-            }
-        },
-        {
-            "$unwind": "$from_city"
-        },
-        {
-            "$lookup": {
-                "from": "cities",
-                "localField": "to_city_id",
-                "foreignField": "_id",
-                "as": "to_city"
-            }
-        },
-        {
-            "$unwind": "$to_city"
-        },
-        {
-            "$group": {
-                "_id": {"from_city": "$from_city.name", "to_city": "$to_city.name"},
-                "avg_duration": {"$avg": "$duration"}
-            }
-        },
-        {
-            "$sort": {"avg_duration": 1}
-        },
-        {
-            "$skip": skip
-        },
-        {
-            "$limit": limit
-        }
-    ]
-
-    flights = list(request.app.database["flights"].aggregate(pipeline))
+@cached_response
+async def average_duration(request: Request, limit: int = 10, skip: int = 0):
+    # route_stats is already grouped by route, only the returned routes are joined with their city names
+    pipeline = group_then_resolve(
+        id={"from_city": "$from_city", "to_city": "$to_city"},
+        fields=["avg_duration"],
+        add_fields={"avg_duration": {"$divide": ["$duration_sum", "$duration_count"]}},
+        sort={"avg_duration": 1, "_id": 1},
+        skip=skip,
+        limit=limit,
+        resolve={"from_city": ("_id.from_city_id", "cities"), "to_city": ("_id.to_city_id", "cities")}
+    )
+    flights = await request.app.database[ROUTE_STATS_COLLECTION].aggregate(pipeline).to_list(length=None)
 
     return flights
 
 
 @router.get("/popular_airlines/", response_description="Get popular airlines", response_model=List[Flight_Popular_Airlines])
-def popular_airlines(request: Request, limit: int = 2, skip: int = 0):
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "airlines",
-                "localField": "airline_id",
-                "foreignField": "_id",
-                "as": "airline"
-            }
-        },
-        {
-            "$unwind": "$airline"
-        },
-        {
-            "$group": {
-                "_id": "$airline.name",
-                "count": {"$sum": 1}
-            }
-        },
-        {
-            "$sort": {"count": -1}
-        },
-        {
-            "$skip": skip
-        },
-        {
-            "$limit": limit
-        }
-    ]
-
-    flights = list(request.app.database["flights"].aggregate(pipeline))
+@cached_response
+async def popular_airlines(request: Request, limit: int = 2, skip: int = 0):
+    # group on airline_id first, only the returned airlines are joined with their names
+    pipeline = group_then_resolve(
+        id="$airline",
+        fields=["count"],
+        group={"_id": "$airline_id", "count": {"$sum": 1}},
+        sort={"count": -1, "_id": 1},
+        skip=skip,
+        limit=limit,
+        resolve={"airline": ("_id", "airlines")}
+    )
+    flights = await request.app.database["flights"].aggregate(pipeline).to_list(length=None)
 
     return flights
-    
@@ -0,0 +1,7 @@
+from fastapi import APIRouter, Request
+
+router = APIRouter()
+
+@router.get("/", response_description="Get the status of the indexes needed by the routes")
+async def index_status(request: Request):
+    return await request.app.index_manager.status()
@@ -0,0 +1,8 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+router = APIRouter()
+
+@router.get("", response_description="Get MongoDB command, pool checkout and route latencies in Prometheus text format", response_class=PlainTextResponse)
+def metrics(request: Request):
+    return PlainTextResponse(request.app.metrics.render(), media_type="text/plain; version=0.0.4")
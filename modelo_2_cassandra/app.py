@@ -45,6 +45,7 @@ def main():
     session.set_keyspace(KEYSPACE)
     
     model.create_schema(session)
+    model.prepare_statements(session)
 
     while True:
         print_menu()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import logging
+import re
 from datetime import datetime
 
+from cassandra import InvalidRequest
+
 # Set logger
 log = logging.getLogger()
 
@@ -78,6 +81,7 @@ SELECT_FLIGHT_BY_ID = """
     SELECT *
     FROM flights
     WHERE flight_id = ?
+    ALLOW FILTERING
 """
 
 SELECT_FLIGHTS_BY_CONNECTION = """
@@ -91,6 +95,7 @@ SELECT_TICKETS_BY_TYPE = """
     SELECT ticket
     FROM tickets_by_f_t
     WHERE ticket_id = ?
+    ALLOW FILTERING
 """
 
 SELECT_FLIGHTS_IDS = """
@@ -130,6 +135,77 @@ QUERY_LUGGAGE_UP_TO_TWO = """
     WHERE ticket = ? 
     AND checked_bags > 2;
 """
+
+TABLE_NAME = re.compile(r"FROM\s+(\w+)", re.IGNORECASE)
+# every query of the model, prepared once per session after create_schema
+QUERIES = [
+    SELECT_ALL_FLIGHTS,
+    SELECT_FLIGHT_BY_ID,
+    SELECT_FLIGHTS_BY_CONNECTION,
+    SELECT_TICKETS_BY_TYPE,
+    SELECT_FLIGHTS_IDS,
+    SELECT_TICKETS_IDS,
+    COUNT_FROM_FLIGHTS_FROM_FLIGHTS,
+    COUNT_FROM_FLIGHTS_TO_FLIGHTS,
+    QUERY_LUGGAGE_SPECIFIC,
+    QUERY_LUGGAGE_UP_TO_TWO,
+]
+
+
+class StatementRegistry:
+    """Prepared statements of a session, prepared again when the table they read changes."""
+
+    def __init__(self, session):
+        self.session = session
+        # query -> (prepared statement, table name, metadata of the table when it was prepared)
+        self._statements = {}
+
+    def _table(self, name):
+        keyspace = self.session.cluster.metadata.keyspaces.get(self.session.keyspace)
+        return keyspace.tables.get(name) if keyspace is not None else None
+
+    def prepare(self, query):
+        name = TABLE_NAME.search(query).group(1)
+        stmt = self.session.prepare(query)
+        self._statements[query] = (stmt, name, self._table(name))
+        return stmt
+
+    def prepare_all(self, queries=QUERIES):
+        log.info(f"Preparing {len(queries)} statements")
+        for query in queries:
+            # a query the cluster rejects fails only when it is run, where get prepares it again
+            try:
+                self.prepare(query)
+            except InvalidRequest as e:
+                log.error(f"Failed to prepare {' '.join(query.split())}: {e}")
+
+    def get(self, query):
+        if query not in self._statements:
+            return self.prepare(query)
+        stmt, name, table = self._statements[query]
+        # the driver replaces the table metadata on every schema change of the table
+        if self._table(name) is not table:
+            log.info(f"Schema of {name} changed, preparing its statement again")
+            stmt = self.prepare(query)
+        return stmt
+
+
+_registries = {}
+
+
+def prepare_statements(session):
+    registry = StatementRegistry(session)
+    registry.prepare_all()
+    _registries[session] = registry
+    return registry
+
+
+def statement(session, query):
+    if session not in _registries:
+        prepare_statements(session)
+    return _registries[session].get(query)
+
+
 #Car rent
 def create_keyspace(session, keyspace, replication_factor):
     log.info(f"Creating keyspace: {keyspace} with replication factor {replication_factor}")
@@ -146,7 +222,7 @@ def create_schema(session):
 
 def get_all_flights(session):
     log.info("Retrieving all flights")
-    stmt = session.prepare(SELECT_ALL_FLIGHTS)
+    stmt = statement(session, SELECT_ALL_FLIGHTS)
     rows = session.execute(stmt)
     for row in rows:
         print(f"=== Flight: {row.flight_id} ===")
@@ -159,7 +235,7 @@ def get_all_flights(session):
 
 def get_flight_by_id(session, flight_id):
     log.info(f"Retrieving flight {flight_id}")
-    stmt = session.prepare(SELECT_FLIGHT_BY_ID)
+    stmt = statement(session, SELECT_FLIGHT_BY_ID)
     rows = session.execute(stmt, [flight_id])
     for row in rows:
         print(f"=== Flight: {row.flight_id} ===")
@@ -172,8 +248,8 @@ def get_flight_by_id(session, flight_id):
 
 def get_flights_by_connection(session):
     log.info("Retrieving flights by connection type")
-    stmt = session.prepare(SELECT_FLIGHTS_BY_CONNECTION)
-    query = session.execute(SELECT_FLIGHTS_IDS)
+    stmt = statement(session, SELECT_FLIGHTS_BY_CONNECTION)
+    query = session.execute(statement(session, SELECT_FLIGHTS_IDS))
 
     flight_ids = []
     count_true = 0
@@ -198,8 +274,8 @@ def get_flights_by_connection(session):
 
 def get_tickets_by_type(session):
     log.info("Retrieving tickets by type")
-    stmt = session.prepare(SELECT_TICKETS_BY_TYPE)
-    query = session.execute(SELECT_TICKETS_IDS)
+    stmt = statement(session, SELECT_TICKETS_BY_TYPE)
+    query = session.execute(statement(session, SELECT_TICKETS_IDS))
 
     ticket_ids = []
     economy = 0
@@ -252,7 +328,7 @@ def get_total_traffic_by_airport(session, airport_code, year):
 def get_departures_by_airport(session, airport_code, year):
     log.info(f"Retrieving departures from {airport_code} in {year}")
 
-    stmt = session.prepare(COUNT_FROM_FLIGHTS_FROM_FLIGHTS)
+    stmt = statement(session, COUNT_FROM_FLIGHTS_FROM_FLIGHTS)
     result = session.execute(stmt, [airport_code, year]).one()
 
 
@@ -268,7 +344,7 @@ def get_departures_by_airport(session, airport_code, year):
 def get_arrivals_by_airport(session, airport_code, year):
     log.info(f"Retrieving arrivals to {airport_code} in {year}")
 
-    stmt = session.prepare(COUNT_FROM_FLIGHTS_TO_FLIGHTS)
+    stmt = statement(session, COUNT_FROM_FLIGHTS_TO_FLIGHTS)
     result = session.execute(stmt, [airport_code, year]).one()
 
     if result[0] > 0:
@@ -283,7 +359,7 @@ def get_arrivals_by_airport(session, airport_code, year):
 def get_high_end_tickets_with_extra_luggage(session, ticket_type):
     log.info("Retrieving tickets for ticket type with more than 2 checked bags")
 
-    stmt = session.prepare(QUERY_LUGGAGE_UP_TO_TWO)
+    stmt = statement(session, QUERY_LUGGAGE_UP_TO_TWO)
     result = session.execute(stmt, [ticket_type])
 
     print("===============================================================")
@@ -296,7 +372,7 @@ def get_high_end_tickets_with_extra_luggage(session, ticket_type):
 def get_high_end_tickets_with_given_luggage(session, ticket_type, luggage_qty):
     log.info("Retrieving tickets for ticket type with a given qty of checked bags")
 
-    stmt = session.prepare(QUERY_LUGGAGE_SPECIFIC)
+    stmt = statement(session, QUERY_LUGGAGE_SPECIFIC)
     result = session.execute(stmt, [ticket_type, luggage_qty])
 
     print("===============================================================")